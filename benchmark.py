@@ -0,0 +1,254 @@
+#!/bin/python3
+"""Time the phases of the simulations, for every simulation type,
+neighbor type, engine and size, and compare the timings to a baseline.
+
+    python3 benchmark.py run --output baseline.json
+    python3 benchmark.py run --output current.json
+    python3 benchmark.py compare baseline.json current.json --threshold 0.2
+
+Phases, in seconds (median over the timed rounds):
+    init    t0 round (play_first / play_gamma_first and scoring)
+    play    play of a round (assign2)
+    score   scoring of a round (assign2)
+    round   whole round, random draws included
+    gather  gather_current_data
+    plot    plot_current
+
+and the time to import evodyn in a fresh interpreter, as paid by every
+worker process, against IMPORT_TARGET (numpy's own import left out).
+
+The 'threaded' engine is timed with each number of threads of --threads,
+printing its round speedup against the first one.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from evodyn import EvoDynUtils, Simulation
+
+SIZES = (50, 100, 200, 500, 1000, 2000)
+ENGINES = {
+    'assign2': ('loop', 'vectorized', 'bitpacked', 'tiled', 'threaded'),
+    'gamma': ('loop', 'compiled')
+}
+NEIGHBOR_TYPES = ('moore', 'von_neumann')
+# Numbers of threads of the 'threaded' engine, to check its scaling
+THREADS = (1, 2, 4, 8)
+# Seconds, spent importing evodyn on top of numpy
+IMPORT_TARGET = 0.1
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def import_time(module, repeat=5):
+    """Return the median time to import module in a fresh interpreter."""
+    code = ('import time; start = time.perf_counter(); import %s; '
+            'print(time.perf_counter() - start)' % module)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return statistics.median(
+        float(subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=directory))
+        for _ in range(repeat))
+
+
+def benchmark_import(repeat=5):
+    """Return the import time of numpy and of evodyn (numpy included)."""
+    times = {'numpy': import_time('numpy', repeat),
+             'evodyn': import_time('evodyn', repeat)}
+    print('import', ' '.join('%s=%.4f' % phase
+                             for phase in sorted(times.items())))
+    if times['evodyn'] - times['numpy'] > IMPORT_TARGET:
+        print("WARNING evodyn import above its target of %.3fs (numpy "
+              "left out)" % IMPORT_TARGET)
+    return times
+
+
+def case_name(simulation_type, neighbor_type, engine, size, threads=None):
+    if threads is not None:
+        engine = '%s-%d' % (engine, threads)
+    return '%s/%s/%s/%d' % (simulation_type, neighbor_type, engine, size)
+
+
+def benchmark_case(config, nround=3):
+    """Return the median time of each phase of a simulation."""
+    results_dir = tempfile.mkdtemp()
+    config = dict(config, results_dir=results_dir, number_of_round=nround + 1,
+                  time_visualize=(), time_visualize_all=False, seed=0)
+    simu = None
+    try:
+        simu = Simulation(config)
+        simu.check_engine()
+        gamma = config['simulation_type'] == 'gamma'
+        if not gamma:
+            simu.payoff = simu.build_payoff()
+        times = {'round': [], 'gather': []}
+        if not gamma:
+            times.update({'play': [], 'score': []})
+        for t in range(nround + 1):
+            start = time.perf_counter()
+            simu.start_round(t)
+            if gamma:
+                simu.play_gamma_round()
+            else:
+                play = timed(simu.play_round)
+                score = timed(simu.score_round)
+            round_time = time.perf_counter() - start
+            if t == 0:
+                times['init'] = [round_time]
+            else:
+                times['round'].append(round_time)
+                if not gamma:
+                    times['play'].append(play)
+                    times['score'].append(score)
+            times['gather'].append(timed(simu.gather_current_data))
+        times['plot'] = [timed(simu.plot_current)]
+        return {phase: statistics.median(values)
+                for phase, values in times.items()}
+    finally:
+        # run() is not called, so the 'threaded' pool is shut down here
+        if simu is not None and simu.executor is not None:
+            simu.executor.shutdown()
+        shutil.rmtree(results_dir)
+
+
+def print_speedups(results, simulation_type, neighbor_type, size, threads):
+    """Print the round speedup of the 'threaded' engine with each number
+    of threads, against its first number of threads (1 by default)."""
+    names = [case_name(simulation_type, neighbor_type, 'threaded', size, n)
+             for n in threads]
+    reference = results[names[0]]['round']
+    print(case_name(simulation_type, neighbor_type, 'threaded', size),
+          'round speedup', ' '.join(
+              '%d=%.2f' % (n, reference / results[name]['round'])
+              for n, name in zip(threads, names)))
+
+
+def run(args):
+    base = EvoDynUtils.get_config(args.config)
+    results = {'import': benchmark_import()}
+    for simulation_type in args.simulation_types:
+        for neighbor_type in NEIGHBOR_TYPES:
+            for engine in ENGINES[simulation_type]:
+                if engine not in args.engines:
+                    continue
+                for size in args.sizes:
+                    if engine == 'loop' and size > args.loop_max_size:
+                        continue
+                    threads = args.threads if engine == 'threaded' \
+                        else (None,)
+                    for nthreads in threads:
+                        name = case_name(simulation_type, neighbor_type,
+                                         engine, size, nthreads)
+                        config = dict(base, simulation_type=simulation_type,
+                                      neighbor_type=neighbor_type,
+                                      engine=engine, size=size,
+                                      threads=nthreads or 0)
+                        # Untimed run on a small lattice, to leave out
+                        # one-time costs such as the numba compilation
+                        benchmark_case(dict(config, size=8), 1)
+                        results[name] = benchmark_case(config, args.rounds)
+                        print(name, ' '.join(
+                            '%s=%.4f' % phase
+                            for phase in sorted(results[name].items())))
+                    if engine == 'threaded':
+                        print_speedups(results, simulation_type,
+                                       neighbor_type, size, args.threads)
+    baseline = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'rounds': args.rounds
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(baseline, f, indent=1)
+    print("Timings written in '%s'" % args.output)
+
+
+def compare(baseline, current, threshold=0.2, min_seconds=0.001):
+    """Return the (case, phase, baseline, current) timings of current
+    slower than baseline by more than threshold (0.2 = 20%), ignoring
+    differences under min_seconds."""
+    regressions = []
+    for name, phases in sorted(current['results'].items()):
+        for phase, seconds in sorted(phases.items()):
+            reference = baseline['results'].get(name, {}).get(phase)
+            if reference is None:
+                continue
+            if seconds > reference * (1 + threshold) \
+                    and seconds - reference > min_seconds:
+                regressions.append((name, phase, reference, seconds))
+    return regressions
+
+
+def run_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold, args.min_seconds)
+    for name, phase, reference, seconds in regressions:
+        print("REGRESSION %s %s: %.4fs -> %.4fs (+%d%%)"
+              % (name, phase, reference, seconds,
+                 (seconds / reference - 1) * 100))
+    if regressions:
+        exit(1)
+    print("No regression above %d%%" % (args.threshold * 100))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="time the phases")
+    run_parser.add_argument('--config', default='sample.py')
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    run_parser.add_argument('--rounds', type=int, default=3,
+                            help="timed rounds after t0")
+    run_parser.add_argument('--simulation-types', nargs='+',
+                            default=sorted(ENGINES))
+    run_parser.add_argument('--engines', nargs='+',
+                            default=['loop', 'vectorized', 'compiled',
+                                     'bitpacked', 'tiled', 'threaded'])
+    run_parser.add_argument('--threads', type=int, nargs='+',
+                            default=THREADS,
+                            help="numbers of threads of the 'threaded' "
+                                 "engine")
+    run_parser.add_argument('--loop-max-size', type=int, default=500,
+                            help="largest size timed with the per-cell "
+                                 "'loop' engine")
+    compare_parser = commands.add_parser('compare',
+                                         help="flag the regressions")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+    compare_parser.add_argument('--min-seconds', type=float, default=0.001)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    EvoDynUtils.init_logging()
+    args = parse_args(sys.argv[1:])
+    if args.command == 'run':
+        run(args)
+    else:
+        run_compare(args)
@@ -1,39 +1,229 @@
 #!/bin/python3
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import random
 import os
 import time
 import logging
 import shutil
-
-# Specify backend, to allow usage from terminal
-plt.switch_backend('agg')
-# Logger
+import collections
+import multiprocessing
+import struct
+import zlib
+import json
+import hashlib
+import ast
+import operator
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Logger, configured by the entry points (see EvoDynUtils.init_logging)
 log = logging.getLogger('EvoDyn')
-logging.basicConfig(level=logging.DEBUG)
 
 ACTIONS = {
     'C': {
         'name': 'cooperate',
         'color': 'blue',
+        'rgb': (0, 0, 255),
         'value': 0
 
     },
     'D': {
         'name': 'defect',
         'color': 'red',
+        'rgb': (255, 0, 0),
         'value': 1
     }
 }
 
 
+# Lattices holding ACTIONS values
+ACTION_DTYPE = np.uint8
+
+
 class SimulationException(Exception):
     pass
 
 
+class Config(dict):
+    """Simulation configuration: a dict of the config values, also
+    readable as attributes, whose known keys are type checked.
+
+    Loaded from a Python file holding assignments only, evaluated
+    without executing it (see Config.load).
+    """
+
+    NUMBER = (int, float)
+    SEQUENCE = (tuple, list)
+    # Accepted types of the known keys
+    TYPES = {
+        'simulation_type': str,
+        'number_of_simulations': int,
+        'number_of_round': int,
+        'workers': int,
+        'quantile_bins': int,
+        'quantiles': SEQUENCE,
+        'seed': (int, type(None)),
+        'size': int,
+        'last_round': SEQUENCE,
+        'start_method': str,
+        'start_coop_probability': NUMBER,
+        'neighbor_type': str,
+        'neighbor_radius': int,
+        'periodic': bool,
+        'graph': (str, type(None)),
+        'graph_file': str,
+        'graph_degree': int,
+        'graph_rewiring': NUMBER,
+        'graph_seed': int,
+        'update_mechanism': str,
+        'fermi_temperature': NUMBER,
+        'float_dtype': (str, type),
+        'engine': str,
+        'tile_size': int,
+        'threads': int,
+        'incremental': bool,
+        'incremental_check': bool,
+        'cycle_detection': (str, type(None)),
+        'cycle_window': int,
+        'instrument': bool,
+        'batch_size': int,
+        'checkpoint_rounds': int,
+        'checkpoint_seconds': NUMBER,
+        'resume': bool,
+        'plots': bool,
+        'time_visualize_all': bool,
+        'time_visualize': SEQUENCE,
+        'show_color_bar': bool,
+        'show_axis': bool,
+        'render_workers': int,
+        'render_queue_size': int,
+        'render_backend': str,
+        'render_scale': int,
+        'record': bool,
+        'record_chunk_rounds': int,
+        'record_compress': bool,
+        'gif': bool,
+        'gif_stride': int,
+        'gif_downscale': int,
+        'gif_scale': int,
+        'gif_delay': int,
+        'results_dir': str,
+        'results_dir_rm': bool,
+        'gamma_p': NUMBER,
+        'gamma': SEQUENCE,
+        'cost_dist': SEQUENCE,
+        'threshold_dist': SEQUENCE,
+        'game': dict,
+        'random_cluster': bool,
+        'middle_cluster_size': int,
+        'middle_cluster_action': str
+    }
+    OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+        ast.USub: operator.neg,
+        ast.UAdd: operator.pos,
+        ast.Not: operator.not_
+    }
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    @classmethod
+    def load(cls, path="sample.py", overrides=None):
+        """Return the configuration defined in path. Values are literals,
+        or arithmetic on the names assigned above them (e.g. the gamma
+        payoffs from b and c). The assignments of the overridden names
+        are skipped, so that the values computed from them use the
+        overrides."""
+        overrides = dict(overrides or {})
+        config = cls(overrides)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in tree.body:
+            if isinstance(node, ast.Expr) \
+                    and isinstance(node.value, ast.Constant):
+                # Docstring
+                continue
+            if not isinstance(node, ast.Assign) or not all(
+                    isinstance(target, ast.Name) for target in node.targets):
+                raise SimulationException("%s:%d: only assignments to names "
+                                          "are allowed" % (path, node.lineno))
+            names = [target.id for target in node.targets]
+            if any(name in overrides for name in names):
+                continue
+            value = config.evaluate(node.value, path)
+            for name in names:
+                config[name] = value
+        config.validate()
+        return config
+
+    def evaluate(self, node, path):
+        """Return the value of the expression node, made of literals,
+        containers, arithmetic operators and names already defined."""
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id not in self:
+                raise SimulationException("%s:%d: unknown name '%s'"
+                                          % (path, node.lineno, node.id))
+            return self[node.id]
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            values = [self.evaluate(element, path) for element in node.elts]
+            return {ast.Tuple: tuple, ast.List: list,
+                    ast.Set: set}[type(node)](values)
+        if isinstance(node, ast.Dict) and None not in node.keys:
+            return {self.evaluate(key, path): self.evaluate(value, path)
+                    for key, value in zip(node.keys, node.values)}
+        if isinstance(node, ast.UnaryOp) \
+                and type(node.op) in self.OPERATORS:
+            return self.apply(node, path, self.evaluate(node.operand, path))
+        if isinstance(node, ast.BinOp) and type(node.op) in self.OPERATORS:
+            return self.apply(node, path, self.evaluate(node.left, path),
+                              self.evaluate(node.right, path))
+        raise SimulationException("%s:%d: unsupported expression '%s'"
+                                  % (path, node.lineno, ast.unparse(node)))
+
+    def apply(self, node, path, *operands):
+        """Return the operator of node applied to operands, raising a
+        SimulationException if it fails (e.g. 10 / 0, (1, 2) - 3)."""
+        try:
+            return self.OPERATORS[type(node.op)](*operands)
+        except (ArithmeticError, TypeError) as e:
+            raise SimulationException("%s:%d: cannot evaluate '%s': %s"
+                                      % (path, node.lineno, ast.unparse(node),
+                                         e)) from None
+
+    def validate(self):
+        """Raise a SimulationException if a known key has a value of the
+        wrong type. Booleans are not accepted as numbers."""
+        for key, types in self.TYPES.items():
+            if key not in self:
+                continue
+            value = self[key]
+            types = types if isinstance(types, tuple) else (types,)
+            if isinstance(value, np.integer):
+                value = int(value)
+            elif isinstance(value, np.floating):
+                value = float(value)
+            if (isinstance(value, bool) and bool not in types) \
+                    or not isinstance(value, types):
+                raise SimulationException(
+                    "Config '%s' must be %s, not %r" % (
+                        key, ' or '.join(t.__name__ for t in types), value))
+        return self
+
+
 class EvoDynUtils:
 
     @staticmethod
@@ -42,25 +232,38 @@ class EvoDynUtils:
         os.mkdir(directory)
 
     @staticmethod
-    def get_config():
+    def get_config(path="sample.py", overrides=None):
+        """Return the Config defined in path, exiting on errors."""
         try:
-            config = {}
-            exec(open("sample.py").read(), config)
-            # FIXME find another way to parse to avoid del builtins
-            del config['__builtins__']
-            return config
+            return Config.load(path, overrides)
         except FileNotFoundError:
-            print("Error: no 'config.py' file found.")
+            print("Error: no '%s' file found." % path)
             exit(1)
-        except Exception as e:
-            log.error("Config Error: ", e)
+        except (SyntaxError, SimulationException) as e:
+            log.error("Config Error: %s" % e)
             exit(1)
 
+    @staticmethod
+    def init_logging(level=logging.DEBUG):
+        """Log to stderr, done by the entry points rather than on import."""
+        logging.basicConfig(level=level)
+
+    @staticmethod
+    def pyplot():
+        """Return matplotlib.pyplot with the 'agg' backend, to allow usage
+        from terminal. matplotlib is only imported on first use, so that
+        importing evodyn (e.g. in every worker process) stays cheap."""
+        import matplotlib
+        matplotlib.use('agg')
+        import matplotlib.pyplot as plt
+        return plt
+
     @staticmethod
     def plot(fig, data, axis, xlabel, ylabel, message=None):
         if message is None:
             message = "Plot x: %s; y:%s" % (xlabel, ylabel)
         log.info("%s in '%s'" % (message, fig))
+        plt = EvoDynUtils.pyplot()
         plt.axis(axis)
         plt.xlabel(xlabel)
         plt.ylabel(ylabel)
@@ -68,6 +271,71 @@ class EvoDynUtils:
         plt.savefig(fig, bbox_inches='tight')
         plt.close()
 
+    @staticmethod
+    def plot_bands(fig, stats, axis, xlabel, ylabel, message=None,
+                   quantiles=None):
+        """Plot the mean of a RunningStats with its 95% confidence band,
+        and the band between the (low, high) quantiles if given."""
+        if message is None:
+            message = "Plot x: %s; y:%s" % (xlabel, ylabel)
+        log.info("%s in '%s'" % (message, fig))
+        rounds = np.arange(len(stats))
+        plt = EvoDynUtils.pyplot()
+        plt.axis(axis)
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+        if quantiles is not None:
+            low, high = quantiles
+            plt.fill_between(rounds, stats.quantile(low), stats.quantile(high),
+                             alpha=0.15, linewidth=0,
+                             label="%d%%-%d%% quantiles" % (low * 100,
+                                                            high * 100))
+        low, high = stats.confidence_interval()
+        plt.fill_between(rounds, low, high, alpha=0.4, linewidth=0,
+                         label="95% confidence interval")
+        plt.plot(rounds, stats.mean, label="Mean")
+        plt.legend()
+        plt.savefig(fig, bbox_inches='tight')
+        plt.close()
+
+    @staticmethod
+    def simulation_seed(master_seed, simuid):
+        """Derive a deterministic seed for simulation simuid
+        from the master seed."""
+        sequence = np.random.SeedSequence(master_seed, spawn_key=(simuid,))
+        return int(sequence.generate_state(1)[0])
+
+    @staticmethod
+    def actions_palette():
+        """Return the rgb colors of the actions, indexed by action value."""
+        actions = sorted(ACTIONS.values(), key=lambda action: action['value'])
+        return [action['rgb'] for action in actions]
+
+    @staticmethod
+    def write_png(path, matrix, palette, scale=1):
+        """Write a matrix of palette indexes as an 8-bit palette PNG,
+        each cell being a scale x scale square of pixels."""
+        image = np.asarray(matrix, dtype=np.uint8)
+        if scale > 1:
+            image = image.repeat(scale, axis=0).repeat(scale, axis=1)
+        height, width = image.shape
+        # Each scanline starts with its filter type, 0 (none)
+        scanlines = np.zeros((height, width + 1), dtype=np.uint8)
+        scanlines[:, 1:] = image
+
+        def chunk(tag, data):
+            crc = zlib.crc32(tag + data) & 0xffffffff
+            return struct.pack('>I', len(data)) + tag + data + \
+                   struct.pack('>I', crc)
+
+        header = struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)
+        with open(path, 'wb') as png:
+            png.write(b'\x89PNG\r\n\x1a\n')
+            png.write(chunk(b'IHDR', header))
+            png.write(chunk(b'PLTE', bytes(c for rgb in palette for c in rgb)))
+            png.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes())))
+            png.write(chunk(b'IEND', b''))
+
     def opposite_action(action):
         if action == 'D':
             return 'C'
@@ -117,30 +385,328 @@ class Neighbor:
 Neighbor.MOORE_NUMBER_OF_NEIGHBORS = 8
 
 
+class Topology:
+    """Neighbor index table of a size x size lattice, built once per
+    simulation. Cells are numbered in row-major order (i * size + j).
+
+    neighbors is a (N, k) int32 array holding the neighbor cells of each
+    cell, in the row-major order of their offsets (the order of
+    Neighbor.moore and Neighbor.von_neumann for radius 1). On
+    non-periodic boundaries, cells have less than k neighbors: the
+    missing ones are set to -1, after the existing ones, and mask is
+    False for them.
+
+    Without tables, only the offsets are kept: the (N, k) tables, and
+    their CSR form, are None.
+    """
+
+    def __init__(self, size, neighbor_type='moore', radius=1, periodic=True,
+                 tables=True):
+        self.size = size
+        self.neighbor_type = neighbor_type
+        self.radius = radius
+        self.periodic = periodic
+        self.offsets = Topology.neighbor_offsets(neighbor_type, radius)
+        if not tables:
+            self.neighbors = self.mask = self.degree = None
+            self.indptr = self.indices = None
+            self.complete = periodic or not self.offsets
+            return
+        self.neighbors, self.mask = self.build_neighbors()
+        self.degree = np.count_nonzero(self.mask, axis=1).astype(np.int32)
+        self.complete = bool(self.mask.all())
+        # Same neighbors, in CSR form (see Graph)
+        self.indptr = np.concatenate(([0], np.cumsum(self.degree))) \
+            .astype(np.int32)
+        self.indices = self.neighbors[self.mask]
+
+    @staticmethod
+    def neighbor_offsets(neighbor_type, radius=1):
+        """Return the (row, col) offsets of the neighbors, in row-major
+        order."""
+        offsets = [(dr, dc)
+                   for dr in range(-radius, radius + 1)
+                   for dc in range(-radius, radius + 1)
+                   if (dr, dc) != (0, 0)]
+        if neighbor_type == 'moore':
+            return tuple(offsets)
+        elif neighbor_type == 'von_neumann':
+            return tuple((dr, dc) for dr, dc in offsets
+                         if abs(dr) + abs(dc) <= radius)
+        else:
+            raise SimulationException("Unknown neighbor_type" \
+                                      ": '%s'" % neighbor_type)
+
+    def build_neighbors(self):
+        rows, cols = np.divmod(np.arange(self.npeople()), self.size)
+        neighbors = np.empty((self.npeople(), len(self.offsets)), np.int32)
+        mask = np.ones(neighbors.shape, dtype=bool)
+        for k, (dr, dc) in enumerate(self.offsets):
+            nrows, ncols = rows + dr, cols + dc
+            if self.periodic:
+                nrows, ncols = nrows % self.size, ncols % self.size
+            else:
+                mask[:, k] = (nrows >= 0) & (nrows < self.size) & \
+                             (ncols >= 0) & (ncols < self.size)
+            neighbors[:, k] = nrows * self.size + ncols
+        if not mask.all():
+            # Move the missing neighbors after the existing ones,
+            # keeping the order of the existing ones
+            order = np.argsort(~mask, axis=1, kind='stable')
+            neighbors = np.take_along_axis(neighbors, order, axis=1)
+            mask = np.take_along_axis(mask, order, axis=1)
+            neighbors[~mask] = -1
+        return neighbors, mask
+
+    def npeople(self):
+        return self.size * self.size
+
+    def max_degree(self):
+        return len(self.offsets)
+
+    def cell(self, i, j):
+        return i * self.size + j
+
+    def cell_neighbors(self, cell):
+        """Return the neighbor cells of cell."""
+        if self.complete:
+            return self.neighbors[cell]
+        return self.neighbors[cell, :self.degree[cell]]
+
+    def closed_neighborhood(self, cells):
+        """Return the sorted cells that are in cells or are neighbors of
+        one of them. Neighborhoods are symmetric, so these are also the
+        cells having one of cells in their neighborhood."""
+        neighbors = self.neighbors[cells].reshape(-1)
+        if not self.complete:
+            neighbors = neighbors[neighbors >= 0]
+        return np.union1d(cells, neighbors)
+
+
+class Graph:
+    """Interaction graph between the size x size cells of a lattice,
+    any cell being possibly linked to any other one. Cells are numbered
+    as in Topology, but only their number matters.
+
+    The graph is undirected, without self-loops nor duplicate edges, and
+    stored in CSR form: the neighbors of cell c are
+    indices[indptr[c]:indptr[c + 1]], in increasing order. Both are int32
+    arrays. The per-cell rules read the neighbors of a cell, the
+    vectorized rules reduce over the segments of indices.
+    """
+
+    # No (N, k) neighbor table, see Topology
+    neighbors = None
+    complete = False
+
+    def __init__(self, size, indptr, indices):
+        self.size = size
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        if len(self.indptr) != self.npeople() + 1 \
+                or self.indptr[-1] != len(self.indices):
+            raise SimulationException("Graph CSR arrays do not describe "
+                                      "%d cells" % self.npeople())
+        self.degree = np.diff(self.indptr).astype(np.int32)
+
+    @staticmethod
+    def from_edges(size, edges):
+        """Return the Graph of size x size cells with the (E, 2) edges,
+        made undirected, self-loops and duplicates being dropped."""
+        npeople = size * size
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        if len(edges) and (edges.min() < 0 or edges.max() >= npeople):
+            raise SimulationException("Graph edges must link cells "
+                                      "0 to %d" % (npeople - 1))
+        sources = np.concatenate((edges[:, 0], edges[:, 1]))
+        targets = np.concatenate((edges[:, 1], edges[:, 0]))
+        codes = np.sort(sources[sources != targets] * npeople
+                        + targets[sources != targets])
+        codes = codes[np.concatenate(([True], codes[1:] != codes[:-1]))]
+        sources, targets = np.divmod(codes, npeople)
+        indptr = np.concatenate(([0], np.cumsum(
+            np.bincount(sources, minlength=npeople))))
+        return Graph(size, indptr, targets)
+
+    @staticmethod
+    def load(size, path):
+        """Return the Graph of the edge list file at path: one edge per
+        line, as two cell numbers, '#' starting comments."""
+        edges = np.loadtxt(path, dtype=np.int64, comments='#', ndmin=2)
+        return Graph.from_edges(size, edges[:, :2])
+
+    @staticmethod
+    def random_regular(size, degree, rng):
+        """Return a random graph whose cells have degree neighbors,
+        pairing the degree stubs of every cell at random (configuration
+        model). The few self-loops and duplicate pairs are dropped,
+        leaving their cells with less neighbors."""
+        npeople = size * size
+        if npeople * degree % 2:
+            raise SimulationException("A random regular graph needs an "
+                                      "even number of stubs")
+        stubs = rng.permutation(np.repeat(np.arange(npeople), degree))
+        return Graph.from_edges(size, stubs.reshape(-1, 2))
+
+    @staticmethod
+    def small_world(size, degree, rewiring, rng):
+        """Return a Watts-Strogatz graph: a ring where each cell is linked
+        to its degree closest cells, each edge having its far end moved
+        to a random cell with probability rewiring."""
+        npeople = size * size
+        sources = np.repeat(np.arange(npeople), degree // 2)
+        offsets = np.tile(np.arange(1, degree // 2 + 1), npeople)
+        targets = (sources + offsets) % npeople
+        rewired = rng.random(len(targets)) < rewiring
+        targets[rewired] = rng.integers(npeople, size=np.count_nonzero(rewired))
+        return Graph.from_edges(size, np.column_stack((sources, targets)))
+
+    @staticmethod
+    def scale_free(size, degree, rng):
+        """Return a Barabasi-Albert graph, each new cell being linked to
+        degree // 2 cells chosen with a probability proportional to their
+        degree (Batagelj and Brandes algorithm). The links chosen twice,
+        or to the cell itself, are dropped.
+
+        The edge list M holds the cell of edge j in M[2j] and its chosen
+        end in M[2j + 1] = M[r], r uniform in [0, 2j]. The ends pointing
+        to other ends are resolved by pointer jumping.
+        """
+        m = max(degree // 2, 1)
+        nedges = size * size * m
+        j = np.arange(nedges)
+        r = rng.integers(2 * j + 1)
+        ends = np.where(r % 2 == 0, r // 2 // m, -1)
+        links = np.where(r % 2 == 0, j, r // 2)
+        unresolved = np.flatnonzero(ends < 0)
+        while len(unresolved):
+            ends[unresolved] = ends[links[unresolved]]
+            links[unresolved] = links[links[unresolved]]
+            unresolved = unresolved[ends[unresolved] < 0]
+        return Graph.from_edges(size, np.column_stack((j // m, ends)))
+
+    def npeople(self):
+        return self.size * self.size
+
+    def max_degree(self):
+        return int(self.degree.max()) if len(self.degree) else 0
+
+    def cell(self, i, j):
+        return i * self.size + j
+
+    def cell_neighbors(self, cell):
+        """Return the neighbor cells of cell."""
+        return self.indices[self.indptr[cell]:self.indptr[cell + 1]]
+
+    def edges(self, cells=None):
+        """Return (indptr, neighbors), the CSR rows of cells, or of every
+        cell if None."""
+        if cells is None:
+            return self.indptr, self.indices
+        degree = self.degree[cells]
+        indptr = np.concatenate(([0], np.cumsum(degree)))
+        positions = np.arange(indptr[-1]) + np.repeat(
+            self.indptr[cells] - indptr[:-1], degree)
+        return indptr, self.indices[positions]
+
+    def closed_neighborhood(self, cells):
+        """Return the sorted cells that are in cells or are neighbors of
+        one of them."""
+        return np.union1d(cells, self.edges(cells)[1])
+
+
+_compiled_kernels = {}
+
+
+def compiled(kernel):
+    """Return kernel compiled with numba, or kernel itself (pure Python)
+    when numba is not installed. numba is only imported on first use."""
+    if kernel not in _compiled_kernels:
+        try:
+            import numba
+            _compiled_kernels[kernel] = numba.njit(cache=True)(kernel)
+        except ImportError:
+            log.warning("numba is not installed, '%s' runs in pure Python"
+                        % kernel.__name__)
+            _compiled_kernels[kernel] = kernel
+    return _compiled_kernels[kernel]
+
+
+def gamma_round_kernel(first, indptr, indices, payoff, cost,
+                       deliberate_action,
+                       first_int_actions, first_thresholds,
+                       previous_int_actions, previous_thresholds,
+                       previous_scores, int_actions, thresholds,
+                       rounds, scores):
+    """Play one round of the gamma simulation on flat arrays.
+
+    Same sweep as Simulation._run_simulation_gamma: for each cell in
+    row-major order, play_gamma, play_deliberate then
+    calculate_score_with_deliberation. Neighbors are given in CSR form
+    (see Graph). Cells later in the sweep are still zeros (cooperate)
+    in rounds when a cell is scored.
+    rounds and scores must be zeros. The first_* arrays are only read
+    when first is True.
+    """
+    for cell in range(len(indptr) - 1):
+        if first:
+            int_action = first_int_actions[cell]
+            threshold = first_thresholds[cell]
+        else:
+            best, best_score = cell, previous_scores[cell]
+            for k in range(indptr[cell], indptr[cell + 1]):
+                neighbor = indices[k]
+                if previous_scores[neighbor] > best_score:
+                    best, best_score = neighbor, previous_scores[neighbor]
+            int_action = previous_int_actions[best]
+            threshold = previous_thresholds[best]
+        int_actions[cell] = int_action
+        thresholds[cell] = threshold
+        if cost <= thresholds[cell]:
+            scores[cell] -= cost * (indptr[cell + 1] - indptr[cell])
+            action = deliberate_action
+        else:
+            action = int_action
+        rounds[cell] = action
+        score = scores[cell]
+        for k in range(indptr[cell], indptr[cell + 1]):
+            score += payoff[action, rounds[indices[k]]]
+        scores[cell] = score
+
+
 class Lattice:
+    """Fixed ring of `depth` preallocated matrices, the last one being
+    the current matrix and the one before the previous matrix."""
 
-    def __init__(self, size):
+    def __init__(self, size, dtype=np.float64, depth=2, replicates=None):
+        """If replicates is given, each matrix stacks replicates
+        (size, size) matrices."""
         self.l = []
         self.size = size
+        self.dtype = dtype
+        # dtype of the values returned by unpack
+        self.value_dtype = dtype
+        self.depth = depth
+        self.shape = (size, size) if replicates is None \
+            else (replicates, size, size)
 
     def add_matrix(self):
-        """Add a numpy.zeros matrix."""
-        dims = (self.size, self.size)
-        matrix = np.zeros(dims)
+        """Add a zeros matrix. Once the lattice holds `depth` matrices,
+        the oldest one is recycled (zeroed in place) instead of allocating
+        a new one, so that the memory used does not grow with the number
+        of rounds."""
+        if len(self.l) < self.depth:
+            matrix = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            matrix = self.l.pop(0)
+            matrix.fill(0)
         self.l.append(matrix)
         return matrix
 
     def reset_current(self):
-        """To avoid using too much memory, this method will:
-        - remove the previous matrix
-        - set the previous matrix as current,
-        - and current set to a new zeros matrix.
-        This should usually be used when only
-        two matrix remains in the lattice.
-        """
-        self.l[-2] = self.l[-1]  # previous = current
-        self.l[-1] = np.zeros((self.size, self.size))
-        return self.current()
+        """Set the previous matrix as current, and the current one to
+        a zeros matrix, reusing the buffer of the oldest matrix."""
+        return self.add_matrix()
 
     def current(self):
         """Return (current) last matrix."""
@@ -153,6 +719,16 @@ class Lattice:
     def current_counts(self, value):
         return np.count_nonzero(self.current() == value)
 
+    def current_sum(self):
+        """Return the sum of the current values, accumulated in float64
+        whatever the dtype."""
+        return float(np.sum(self.current(), dtype=np.float64))
+
+    def unpack(self, matrix):
+        """Return the values of a matrix of the lattice: the matrix
+        itself (see BitLattice)."""
+        return matrix
+
     def __str__(self):
         return str(self.l)
 
@@ -160,19 +736,886 @@ class Lattice:
         return str(self)
 
 
+class BitLattice(Lattice):
+    """Lattice of 0/1 values packed 64 cells per uint64 word: cell (i, j)
+    is the bit j % 64 of the word j // 64 of row i, and the padding bits
+    after the last column are always 0.
+
+    With planes, each matrix holds planes bit planes of small integers
+    (bit-sliced): plane b holds the bit b of the value of every cell.
+    Matrices are updated with word-parallel bitwise operations, the
+    neighbors of the cells being read by shifting whole matrices on the
+    torus (see shift).
+    """
+
+    WORD_BITS = 64
+
+    def __init__(self, size, depth=2, planes=None):
+        super().__init__(size, np.uint64, depth)
+        self.value_dtype = ACTION_DTYPE
+        self.planes = planes
+        self.nwords = -(-size // BitLattice.WORD_BITS)
+        self.shape = (size, self.nwords) if planes is None \
+            else (planes, size, self.nwords)
+        # Bits of the cells of a row, without the padding bits
+        self.row_mask = self.pack(np.ones((1, size)))[0]
+
+    @staticmethod
+    def popcount(words):
+        """Return the number of bits set in words."""
+        if hasattr(np, 'bitwise_count'):
+            return int(np.bitwise_count(words).sum(dtype=np.int64))
+        return int(BitLattice.BYTE_COUNTS[
+            np.ascontiguousarray(words).view(np.uint8)].sum(dtype=np.int64))
+
+    def pack(self, matrix):
+        """Return the packed words of a (..., size, size) matrix of 0/1
+        values."""
+        bits = np.packbits(np.asarray(matrix) != 0, axis=-1,
+                           bitorder='little')
+        words = np.zeros(bits.shape[:-1] + (self.nwords * 8,), np.uint8)
+        words[..., :bits.shape[-1]] = bits
+        return words.view('<u8').astype(np.uint64)
+
+    def unpack_bits(self, matrix):
+        words = np.ascontiguousarray(matrix, dtype='<u8')
+        return np.unpackbits(words.view(np.uint8), axis=-1, count=self.size,
+                             bitorder='little')
+
+    def unpack(self, matrix):
+        """Return the (size, size) values of a matrix of the lattice."""
+        if self.planes is None:
+            return self.unpack_bits(matrix)
+        values = np.zeros((self.size, self.size), dtype=self.value_dtype)
+        for b, plane in enumerate(matrix):
+            values |= self.unpack_bits(plane) << b
+        return values
+
+    def current_counts(self, value):
+        ones = BitLattice.popcount(self.current())
+        return {0: self.size * self.size - ones, 1: ones}.get(value, 0)
+
+    def current_sum(self):
+        planes = [self.current()] if self.planes is None else self.current()
+        return float(sum(BitLattice.popcount(plane) << b
+                         for b, plane in enumerate(planes)))
+
+    def cells(self, matrix, value):
+        """Return the bits of the cells of matrix holding value (0 or 1)."""
+        return matrix.copy() if value else ~matrix & self.row_mask
+
+    @staticmethod
+    def shift_words(words, q):
+        """Return words whose word k is the word k + q of words along the
+        last axis, 0 out of the rows."""
+        shifted = np.zeros_like(words)
+        n = words.shape[-1]
+        if abs(q) >= n:
+            return shifted
+        if q >= 0:
+            shifted[..., :n - q] = words[..., q:]
+        else:
+            shifted[..., -q:] = words[..., :n + q]
+        return shifted
+
+    @staticmethod
+    def shift_bits(words, n):
+        """Return words whose bit j is the bit j + n of words along the
+        last axis, 0 out of the rows."""
+        q, r = divmod(n, BitLattice.WORD_BITS)
+        shifted = BitLattice.shift_words(words, q) >> np.uint64(r)
+        if r:
+            shifted |= BitLattice.shift_words(words, q + 1) \
+                << np.uint64(BitLattice.WORD_BITS - r)
+        return shifted
+
+    def shift(self, matrix, dr, dc):
+        """Return the matrix whose cell (i, j) is the cell (i + dr, j + dc)
+        of matrix, on the torus."""
+        if dr % self.size:
+            matrix = np.roll(matrix, -dr, axis=-2)
+        dc %= self.size
+        if dc == 0:
+            return matrix
+        # The cells j + dc < size, then the ones wrapped around
+        return (BitLattice.shift_bits(matrix, dc)
+                | BitLattice.shift_bits(matrix, dc - self.size)) \
+            & self.row_mask
+
+    @staticmethod
+    def greater(a, b):
+        """Return the bits of the cells whose bit-sliced value a is greater
+        than b, the planes being given from the least significant bit."""
+        greater = np.zeros_like(a[0])
+        equal = ~greater
+        for a_plane, b_plane in zip(reversed(a), reversed(b)):
+            greater |= equal & a_plane & ~b_plane
+            equal &= ~(a_plane ^ b_plane)
+        return greater
+
+    @staticmethod
+    def copy_where(out, value, where):
+        """Copy the bits of value to out where the bits of where are set."""
+        out ^= (out ^ value) & where
+
+
+# Number of bits set in each byte
+BitLattice.BYTE_COUNTS = np.array([bin(byte).count('1') for byte in range(256)],
+                                  dtype=np.uint8)
+
+
+class TiledMatrix:
+    """(size, size) matrix stored in a file as square tiles of
+    tile_size x tile_size cells, in row-major order, the tiles of the
+    last row and column being padded. Each tile is contiguous in the
+    file, and memory mapped only while it is read or written, so that
+    only the tiles in use are held in memory."""
+
+    def __init__(self, path, size, dtype, tile_size):
+        self.path = path
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.ntiles = -(-size // tile_size)
+        self.tile_bytes = tile_size * tile_size * self.dtype.itemsize
+        self.shape = (size, size)
+        self.nbytes = size * size * self.dtype.itemsize
+        self.clear()
+
+    def clear(self):
+        """Set every cell to 0, by recreating the file (sparse)."""
+        with open(self.path, 'wb') as f:
+            f.truncate(self.ntiles * self.ntiles * self.tile_bytes)
+
+    def tile(self, a, b, mode='r'):
+        """Return the memory map of the tile (a, b)."""
+        return np.memmap(self.path, self.dtype, mode,
+                         offset=(a * self.ntiles + b) * self.tile_bytes,
+                         shape=(self.tile_size, self.tile_size))
+
+    def tiles(self):
+        """Return the (rows, cols) ranges of the cells of each tile."""
+        starts = range(0, self.size, self.tile_size)
+        return [(range(r, min(r + self.tile_size, self.size)),
+                 range(c, min(c + self.tile_size, self.size)))
+                for r in starts for c in starts]
+
+    def tile_blocks(self, rows, cols):
+        """Yield, for each tile holding some of the rows x cols cells
+        (index arrays), (a, b, i, j, ti, tj): the tile (a, b), the
+        positions i and j of its cells in rows and cols, and their
+        indexes ti and tj in the tile."""
+        row_tiles, row_offsets = np.divmod(np.asarray(rows), self.tile_size)
+        col_tiles, col_offsets = np.divmod(np.asarray(cols), self.tile_size)
+        for a in np.unique(row_tiles):
+            i = np.flatnonzero(row_tiles == a)
+            for b in np.unique(col_tiles):
+                j = np.flatnonzero(col_tiles == b)
+                yield a, b, i, j, row_offsets[i], col_offsets[j]
+
+    def read(self, rows, cols):
+        """Return the rows x cols cells, rows and cols being indexes."""
+        values = np.empty((len(rows), len(cols)), dtype=self.dtype)
+        for a, b, i, j, ti, tj in self.tile_blocks(rows, cols):
+            values[np.ix_(i, j)] = self.tile(a, b)[np.ix_(ti, tj)]
+        return values
+
+    def write(self, rows, cols, values):
+        """Write values in the rows x cols cells."""
+        for a, b, i, j, ti, tj in self.tile_blocks(rows, cols):
+            tile = self.tile(a, b, 'r+')
+            tile[np.ix_(ti, tj)] = values[np.ix_(i, j)]
+            tile.flush()
+
+
+class TiledLattice(Lattice):
+    """Lattice whose matrices are TiledMatrix files in directory, larger
+    than the memory if needed: they are only read and written tile by
+    tile, and the counts and sums are accumulated tile by tile."""
+
+    def __init__(self, size, dtype, directory, name, tile_size=1024,
+                 depth=2):
+        super().__init__(size, dtype, depth)
+        self.directory = directory
+        self.name = name
+        self.tile_size = tile_size
+        os.makedirs(directory, exist_ok=True)
+
+    def add_matrix(self):
+        """Add a zeros matrix, recycling the file of the oldest one once
+        the lattice holds `depth` matrices."""
+        if len(self.l) < self.depth:
+            path = os.path.join(self.directory,
+                                '%s_%d.tiles' % (self.name, len(self.l)))
+            matrix = TiledMatrix(path, self.size, self.dtype, self.tile_size)
+        else:
+            matrix = self.l.pop(0)
+            matrix.clear()
+        self.l.append(matrix)
+        return matrix
+
+    def current_tiles(self):
+        """Yield the tiles of the current matrix, read one at a time."""
+        matrix = self.current()
+        for rows, cols in matrix.tiles():
+            yield matrix.read(rows, cols)
+
+    def current_counts(self, value):
+        return sum(np.count_nonzero(tile == value)
+                   for tile in self.current_tiles())
+
+    def current_sum(self):
+        return float(sum(np.sum(tile, dtype=np.float64)
+                         for tile in self.current_tiles()))
+
+    def unpack(self, matrix):
+        """Return the whole matrix, read in memory."""
+        return matrix.read(range(self.size), range(self.size))
+
+
+def render_snapshot(matrix, fig, options):
+    """Render an action matrix in fig (without extension).
+    options holds the show_axis, show_color_bar, render_backend and
+    render_scale configuration values."""
+    if options['render_backend'] == 'png':
+        EvoDynUtils.write_png(fig + '.png', matrix,
+                              EvoDynUtils.actions_palette(),
+                              options['render_scale'])
+        return
+    plt = EvoDynUtils.pyplot()
+    from matplotlib.colors import from_levels_and_colors
+    # NOTE from_level_colors will color blue between 0, 1 and
+    # red between 1 and 2, there is maybe a better way for discrete values.
+    levels = [0, 1, 2]
+    colors = [ACTIONS['C']['color'], ACTIONS['D']['color']]
+    cmap, norm = from_levels_and_colors(levels, colors)
+    plot = plt.matshow(matrix, cmap=cmap, norm=norm)
+    if not options['show_axis']:
+        plot.axes.get_xaxis().set_visible(False)
+        plot.axes.get_yaxis().set_visible(False)
+        plt.axis('off')
+    if options['show_color_bar']:
+        plt.colorbar()
+    plt.savefig(fig, bbox_inches='tight')
+    plt.close()
+
+
+def render_snapshots(queue, options):
+    """Render the (matrix, fig) snapshots of queue until None is received.
+    Used as the entry point of the SnapshotRenderer processes."""
+    while True:
+        snapshot = queue.get()
+        if snapshot is None:
+            return
+        matrix, fig = snapshot
+        try:
+            render_snapshot(matrix, fig, options)
+        except Exception as e:
+            log.error("Cannot render '%s': %r" % (fig, e))
+
+
+class SnapshotRenderer:
+    """Render the action matrix snapshots of a simulation.
+
+    With config.render_workers > 0, snapshots are pushed onto a bounded
+    queue drained by that many renderer processes: the simulation only
+    pays for a copy of the matrix, and blocks when render_queue_size
+    snapshots are waiting. Otherwise snapshots are rendered synchronously.
+    """
+
+    def __init__(self, config):
+        self.options = {
+            'show_axis': config['show_axis'],
+            'show_color_bar': config['show_color_bar'],
+            'render_backend': config.get('render_backend', 'matplotlib'),
+            'render_scale': config.get('render_scale', 4)
+        }
+        if self.options['render_backend'] not in ('matplotlib', 'png'):
+            raise SimulationException("Unknown render_backend: '%s'"
+                                      % self.options['render_backend'])
+        self.nworkers = config.get('render_workers', 0)
+        self.queue = None
+        self.workers = []
+        if self.nworkers > 0:
+            self.queue = multiprocessing.Queue(
+                config.get('render_queue_size', 16))
+            for _ in range(self.nworkers):
+                worker = multiprocessing.Process(
+                    target=render_snapshots, args=(self.queue, self.options))
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, matrix, fig):
+        snapshot = np.array(matrix, dtype=ACTION_DTYPE)
+        if self.queue is None:
+            render_snapshot(snapshot, fig, self.options)
+        else:
+            self.queue.put((snapshot, fig))
+
+    def close(self, terminate=False):
+        """Wait for the pending snapshots to be rendered and stop the
+        renderer processes, or drop the pending ones if terminate."""
+        for worker in self.workers:
+            if terminate:
+                worker.terminate()
+            else:
+                self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+class RunningStats:
+    """Running count, mean, variance (Welford), min and max of series,
+    round by round, updated one series at a time in constant memory.
+
+    Series can have different lengths, each round only accounting for
+    the series long enough. If bins > 0, a histogram of bins bins over
+    value_range is also kept for each round, to estimate quantiles.
+    """
+
+    def __init__(self, value_range=(0, 100), bins=0):
+        self.value_range = value_range
+        self.bins = bins
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+        self.histogram = np.zeros((0, bins), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.count)
+
+    def grow(self, nround):
+        extra = nround - len(self)
+        if extra <= 0:
+            return
+        self.count = np.append(self.count, np.zeros(extra, dtype=np.int64))
+        self.mean = np.append(self.mean, np.zeros(extra))
+        self.m2 = np.append(self.m2, np.zeros(extra))
+        self.min = np.append(self.min, np.full(extra, np.inf))
+        self.max = np.append(self.max, np.full(extra, -np.inf))
+        self.histogram = np.concatenate((self.histogram, np.zeros(
+            (extra, self.bins), dtype=np.int64)))
+
+    def update(self, series):
+        values = np.asarray(series, dtype=np.float64)
+        n = len(values)
+        self.grow(n)
+        self.count[:n] += 1
+        delta = values - self.mean[:n]
+        self.mean[:n] += delta / self.count[:n]
+        self.m2[:n] += delta * (values - self.mean[:n])
+        np.minimum(self.min[:n], values, out=self.min[:n])
+        np.maximum(self.max[:n], values, out=self.max[:n])
+        if self.bins > 0:
+            low, high = self.value_range
+            bins = ((values - low) / (high - low) * self.bins).astype(int)
+            bins = np.clip(bins, 0, self.bins - 1)
+            self.histogram[np.arange(n), bins] += 1
+
+    def variance(self):
+        """Return the sample variance of each round (0 with one value)."""
+        return self.m2 / np.maximum(self.count - 1, 1)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def confidence_interval(self, z=1.96):
+        """Return the (low, high) bounds of the confidence interval of
+        the mean of each round, 95% with the default z."""
+        margin = z * self.std() / np.sqrt(np.maximum(self.count, 1))
+        return self.mean - margin, self.mean + margin
+
+    def quantile(self, q):
+        """Return the estimated q quantile of each round, interpolated
+        in the histogram bins."""
+        if self.bins == 0:
+            raise SimulationException("Quantiles require bins > 0")
+        low, high = self.value_range
+        width = (high - low) / self.bins
+        cumulative = np.cumsum(self.histogram, axis=1)
+        target = q * self.count
+        # First bin reaching the target
+        bins = np.argmax(cumulative >= target[:, np.newaxis], axis=1)
+        rounds = np.arange(len(self))
+        before = cumulative[rounds, bins] - self.histogram[rounds, bins]
+        inside = self.histogram[rounds, bins]
+        fraction = np.where(inside > 0, (target - before)
+                            / np.maximum(inside, 1), 0)
+        return low + (bins + fraction) * width
+
+    def summary(self):
+        return {
+            'count': self.count.tolist(),
+            'mean': self.mean.tolist(),
+            'std': self.std().tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist()
+        }
+
+
+class CycleDetector:
+    """Detect when a lattice comes back to one of its last `window`
+    states, by hashing its buffer every round."""
+
+    def __init__(self, window=8):
+        self.window = window
+        self.history = collections.deque()
+        self.rounds = {}
+
+    @staticmethod
+    def digest(matrix):
+        return hashlib.blake2b(np.ascontiguousarray(matrix).data,
+                               digest_size=16).digest()
+
+    def update(self, t, matrix):
+        """Add the state of round t. Return (first_round, period) if it
+        is the state of round first_round = t - period, None otherwise."""
+        digest = CycleDetector.digest(matrix)
+        if digest in self.rounds:
+            first_round = self.rounds[digest]
+            return first_round, t - first_round
+        self.history.append((t, digest))
+        self.rounds[digest] = t
+        if len(self.history) > self.window:
+            _, oldest = self.history.popleft()
+            del self.rounds[oldest]
+        return None
+
+
+class Instrumentation:
+    """Time the rounds and the phases of a simulation, count the calls of
+    its per-cell methods and track the memory of its lattices.
+
+    Only used when enabled: the timed and counted methods are wrapped on
+    the simulation instance, leaving the class methods untouched.
+    """
+
+    # Round phases, timed around each call
+    PHASES = ('start_round', 'play_and_score_round', 'play_gamma_round',
+              'end_round')
+    # Per-cell methods, counted at each call
+    COUNTED = ('neighbors', 'play', 'play_gamma', 'calculate_score',
+               'calculate_score_with_deliberation')
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.round_seconds = []
+        self.phase_seconds = {phase: 0.0 for phase in self.PHASES}
+        self.phase_calls = {phase: 0 for phase in self.PHASES}
+        self.calls = {name: 0 for name in self.COUNTED}
+        self.peak_lattice_bytes = 0
+        self.round_start = None
+        self.start = time.perf_counter()
+        for phase in self.PHASES:
+            setattr(simulation, phase,
+                    self.timed(phase, getattr(simulation, phase)))
+        for name in self.COUNTED:
+            setattr(simulation, name,
+                    self.counted(name, getattr(simulation, name)))
+        simulation.add_hook('on_round_start', self.on_round_start)
+        simulation.add_hook('on_round_end', self.on_round_end)
+
+    def timed(self, phase, method):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.phase_seconds[phase] += time.perf_counter() - start
+                self.phase_calls[phase] += 1
+        return wrapper
+
+    def counted(self, name, method):
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    def lattice_bytes(self):
+        simulation = self.simulation
+        return sum(matrix.nbytes for lattice in (
+            simulation.rounds, simulation.scores, simulation.thresholds,
+            simulation.intuitive_actions) for matrix in lattice.l)
+
+    def on_round_start(self, simulation):
+        self.round_start = time.perf_counter()
+
+    def on_round_end(self, simulation):
+        self.round_seconds.append(time.perf_counter() - self.round_start)
+        self.peak_lattice_bytes = max(self.peak_lattice_bytes,
+                                      self.lattice_bytes())
+
+    def summary(self):
+        nrounds = len(self.round_seconds)
+        ncells = nrounds * self.simulation.npeople()
+        rounds = np.array(self.round_seconds)
+        return {
+            'rounds': nrounds,
+            'seconds': time.perf_counter() - self.start,
+            'round_seconds': {
+                'mean': float(rounds.mean()) if nrounds else None,
+                'min': float(rounds.min()) if nrounds else None,
+                'max': float(rounds.max()) if nrounds else None,
+                'all': self.round_seconds
+            },
+            'phases': {phase: {'calls': self.phase_calls[phase],
+                               'seconds': self.phase_seconds[phase]}
+                       for phase in self.PHASES if self.phase_calls[phase]},
+            'calls': self.calls,
+            'calls_per_cell': {name: calls / ncells if ncells else 0
+                               for name, calls in self.calls.items()},
+            'peak_lattice_bytes': self.peak_lattice_bytes
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+class GifWriter:
+    """Write an animated GIF of palette index matrices, frame by frame,
+    so that only the current frame is held in memory.
+    Frames are downscaled by keeping one cell out of downscale in each
+    direction, then each cell is drawn as a scale x scale square."""
+
+    def __init__(self, path, palette, delay=10, downscale=1, scale=1):
+        """delay is the time between frames, in hundredths of second."""
+        self.path = path
+        self.palette = list(palette)
+        self.delay = delay
+        self.downscale = downscale
+        self.scale = scale
+        self.min_code_size = max(2, (len(self.palette) - 1).bit_length())
+        self.file = None
+        self.shape = None
+        self.nframes = 0
+
+    def frame_image(self, matrix):
+        image = np.asarray(matrix, dtype=np.uint8)
+        image = image[::self.downscale, ::self.downscale]
+        if self.scale > 1:
+            image = image.repeat(self.scale, axis=0) \
+                         .repeat(self.scale, axis=1)
+        return image
+
+    def write_header(self, shape):
+        height, width = shape
+        ncolors = 1 << self.min_code_size
+        palette = self.palette + [(0, 0, 0)] * (ncolors - len(self.palette))
+        self.file = open(self.path, 'wb')
+        self.file.write(b'GIF89a')
+        # Global color table of 2 ** (min_code_size) colors
+        self.file.write(struct.pack('<HHBBB', width, height,
+                                    0xf0 | (self.min_code_size - 1), 0, 0))
+        self.file.write(bytes(c for rgb in palette for c in rgb))
+        # Netscape extension: loop forever
+        self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+        self.shape = shape
+
+    @staticmethod
+    def lzw_encode(indexes, min_code_size):
+        """Return the GIF LZW compressed bytes of a sequence of indexes."""
+        clear, end = 1 << min_code_size, (1 << min_code_size) + 1
+        output = bytearray()
+        bits, nbits = 0, 0
+        code_size, next_code, table = min_code_size + 1, end + 1, {}
+
+        def emit(code, size):
+            nonlocal bits, nbits
+            bits |= code << nbits
+            nbits += size
+            while nbits >= 8:
+                output.append(bits & 0xff)
+                bits >>= 8
+                nbits -= 8
+
+        emit(clear, code_size)
+        prefix = indexes[0]
+        for index in indexes[1:]:
+            key = prefix << 8 | index
+            code = table.get(key)
+            if code is not None:
+                prefix = code
+                continue
+            emit(prefix, code_size)
+            if next_code < 4096:
+                table[key] = next_code
+                next_code += 1
+                if next_code > (1 << code_size) and code_size < 12:
+                    code_size += 1
+            else:
+                emit(clear, code_size)
+                code_size, next_code, table = min_code_size + 1, end + 1, {}
+            prefix = index
+        emit(prefix, code_size)
+        emit(end, code_size)
+        if nbits > 0:
+            output.append(bits & 0xff)
+        return bytes(output)
+
+    def add_frame(self, matrix):
+        image = self.frame_image(matrix)
+        if self.file is None:
+            self.write_header(image.shape)
+        elif image.shape != self.shape:
+            raise SimulationException("GIF frames must all have the "
+                                      "same shape")
+        height, width = image.shape
+        # Graphic control extension: delay
+        self.file.write(struct.pack('<BBBBHBB', 0x21, 0xf9, 4, 0,
+                                    self.delay, 0, 0))
+        # Image descriptor, without local color table
+        self.file.write(struct.pack('<BHHHHB', 0x2c, 0, 0, width, height, 0))
+        self.file.write(bytes([self.min_code_size]))
+        data = GifWriter.lzw_encode(image.reshape(-1).tolist(),
+                                    self.min_code_size)
+        for start in range(0, len(data), 255):
+            block = data[start:start + 255]
+            self.file.write(bytes([len(block)]) + block)
+        self.file.write(b'\x00')
+        self.nframes += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(b'\x3b')
+            self.file.close()
+            self.file = None
+
+
+class TrajectoryRecorder:
+    """Record some lattices of every round of a simulation in directory.
+
+    Without compression, each lattice is written in a .npy file holding
+    the nround matrices, preallocated and written through a memory map,
+    flushed every chunk_rounds rounds. With compression, every
+    chunk_rounds rounds are written in a compressed .npz chunk.
+    A meta.json file describes the layout for TrajectoryReader.
+    """
+
+    META = 'meta.json'
+
+    def __init__(self, directory, dtypes, shape, nround, chunk_rounds=64,
+                 compress=False, recorded=0):
+        """dtypes maps the name of each recorded lattice to its dtype.
+        If recorded > 0, the recording of directory is resumed after its
+        first recorded rounds."""
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.nround = nround
+        self.chunk_rounds = chunk_rounds
+        self.compress = compress
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        self.recorded = recorded
+        os.makedirs(directory, exist_ok=True)
+        self.frames = {}
+        for name, dtype in self.dtypes.items():
+            if compress:
+                self.frames[name] = np.zeros(
+                    (chunk_rounds,) + self.shape, dtype=dtype)
+                chunk, nframes = divmod(recorded, chunk_rounds)
+                if nframes:
+                    with np.load(TrajectoryRecorder.path(
+                            directory, name, chunk)) as frames:
+                        self.frames[name][:nframes] = \
+                            frames['frames'][:nframes]
+            else:
+                self.frames[name] = np.lib.format.open_memmap(
+                    TrajectoryRecorder.path(directory, name),
+                    mode='r+' if recorded else 'w+',
+                    dtype=dtype, shape=(nround,) + self.shape)
+        self.write_meta()
+
+    @staticmethod
+    def path(directory, name, chunk=None):
+        if chunk is None:
+            return os.path.join(directory, '%s.npy' % name)
+        return os.path.join(directory, '%s.%06d.npz' % (name, chunk))
+
+    def write_meta(self):
+        meta = {
+            'shape': self.shape,
+            'nround': self.nround,
+            'recorded': self.recorded,
+            'chunk_rounds': self.chunk_rounds,
+            'compress': self.compress,
+            'dtypes': {name: dtype.str for name, dtype in self.dtypes.items()}
+        }
+        with open(os.path.join(self.directory, self.META), 'w') as f:
+            json.dump(meta, f)
+
+    def record(self, lattices):
+        """Record the next round, lattices mapping names to matrices."""
+        t = self.recorded
+        if t >= self.nround:
+            raise SimulationException("Cannot record more than %d rounds"
+                                      % self.nround)
+        for name, frames in self.frames.items():
+            frames[t % self.chunk_rounds if self.compress else t] = \
+                lattices[name]
+        self.recorded += 1
+        if self.recorded % self.chunk_rounds == 0:
+            self.flush()
+
+    def flush(self):
+        """Write the rounds recorded since the last flush."""
+        if self.compress:
+            if self.recorded == 0:
+                return
+            chunk = (self.recorded - 1) // self.chunk_rounds
+            nframes = self.recorded - chunk * self.chunk_rounds
+            for name, frames in self.frames.items():
+                np.savez_compressed(
+                    TrajectoryRecorder.path(self.directory, name, chunk),
+                    frames=frames[:nframes])
+        else:
+            for frames in self.frames.values():
+                frames.flush()
+        self.write_meta()
+
+    def close(self):
+        if self.recorded % self.chunk_rounds != 0:
+            self.flush()
+        self.frames = {}
+
+
+class TrajectoryReader:
+    """Read the lattices written by a TrajectoryRecorder, loading only
+    the requested rounds."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, TrajectoryRecorder.META)) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.nround = meta['recorded']
+        self.chunk_rounds = meta['chunk_rounds']
+        self.compress = meta['compress']
+        self.dtypes = {name: np.dtype(dtype)
+                       for name, dtype in meta['dtypes'].items()}
+
+    def names(self):
+        return list(self.dtypes)
+
+    def __len__(self):
+        return self.nround
+
+    def chunk(self, name, chunk):
+        path = TrajectoryRecorder.path(self.directory, name, chunk)
+        with np.load(path) as npz:
+            return npz['frames']
+
+    def rounds(self, name, start=0, stop=None):
+        """Return the matrices of lattice name from round start to stop
+        (excluded) as a (stop - start, ...) array."""
+        start, stop, _ = slice(start, stop).indices(self.nround)
+        stop = max(start, stop)
+        if not self.compress:
+            frames = np.load(TrajectoryRecorder.path(self.directory, name),
+                             mmap_mode='r')
+            return np.array(frames[start:stop])
+        matrices = np.empty((stop - start,) + self.shape,
+                            dtype=self.dtypes[name])
+        t = start
+        while t < stop:
+            chunk, offset = divmod(t, self.chunk_rounds)
+            frames = self.chunk(name, chunk)[offset:offset + stop - t]
+            matrices[t - start:t - start + len(frames)] = frames
+            t += len(frames)
+        return matrices
+
+    def round(self, name, t):
+        """Return the matrix of lattice name in round t."""
+        t = range(self.nround)[t]
+        return self.rounds(name, t, t + 1)[0]
+
+    def cell(self, name, index, start=0, stop=None):
+        """Return the values of the cell index (a (row, col) tuple for
+        square lattices) from round start to stop (excluded)."""
+        start, stop, _ = slice(start, stop).indices(self.nround)
+        stop = max(start, stop)
+        index = tuple(np.atleast_1d(index))
+        if not self.compress:
+            frames = np.load(TrajectoryRecorder.path(self.directory, name),
+                             mmap_mode='r')
+            return np.array(frames[(slice(start, stop),) + index])
+        values = []
+        t = start
+        while t < stop:
+            chunk, offset = divmod(t, self.chunk_rounds)
+            frames = self.chunk(name, chunk)[offset:offset + stop - t]
+            values.append(frames[(slice(None),) + index])
+            t += len(frames)
+        if not values:
+            return np.empty(0, dtype=self.dtypes[name])
+        return np.concatenate(values)
+
+
+def export_gif(reader, path, name='rounds', stride=1, delay=10,
+               downscale=1, scale=1, palette=None):
+    """Write an animated GIF of every stride round of the lattice name
+    recorded in a TrajectoryReader, reading rounds chunk by chunk."""
+    if palette is None:
+        palette = EvoDynUtils.actions_palette()
+    writer = GifWriter(path, palette, delay, downscale, scale)
+    chunk_rounds = max(reader.chunk_rounds - reader.chunk_rounds % stride,
+                       stride)
+    for start in range(0, len(reader), chunk_rounds):
+        frames = reader.rounds(name, start, start + chunk_rounds)
+        for frame in frames[::stride]:
+            writer.add_frame(frame)
+    writer.close()
+    return writer.nframes
+
+
 class Simulation:
 
-    def __init__(self, config, simuid=None):
+    # Cells of the start lattice played at once by the 'bitpacked' engine
+    START_CHUNK_CELLS = 1 << 20
+
+    def __init__(self, config, simuid=None, seed=None):
         self.simuid = simuid
-        self.config = config
+        self.config = (config if isinstance(config, Config)
+                       else Config(config)).validate()
         self.size = self.config['size']
         self._results_dir = None
         self.t = 0
+        self.seed = self.init_seed(seed)
+        self.rng = np.random.default_rng(self.seed)
+        self.draws = {}
+        self.dirty = None
+        self.cycle_detector = None
+        self.renderer = None
+        self.recorder = None
+        self.gif = None
+        self.executor = None
+        self.hooks = {'on_round_start': [], 'on_round_end': []}
+        self.checkpoint_rounds = self.config.get('checkpoint_rounds', 0)
+        self.checkpoint_seconds = self.config.get('checkpoint_seconds', 0)
+        self.last_checkpoint = None
+        self.interrupted = False
+        self.sigint_handler = None
         self._data = self.init_data()
-        self.rounds, self.scores, self.thresholds = self.init_lattices()
-        self.init_actions = np.zeros((self.size, self.size))
-        self.intuitive_actions = Lattice(self.size)
         self.generate_results_dir()
+        self.topology = self.build_topology()
+        self.rounds, self.scores, self.thresholds, self.intuitive_actions \
+            = self.init_lattices()
+        self.compile_rules()
+        self.instrumentation = Instrumentation(self) \
+            if self.config.get('instrument', False) else None
+
+    def init_seed(self, seed):
+        """Return seed, or config.seed if seed is None. Without any
+        seed, a random one is generated, so that the run can be
+        reproduced by setting it in the config."""
+        if seed is None:
+            seed = self.config.get('seed')
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        log.info("Simulation seed: %d" % seed)
+        return seed
 
     def data(self, key=None):
         return self._data if key is None else self._data[key]
@@ -181,21 +1624,69 @@ class Simulation:
         return {
             'coop_levels': list(),
             'int_coop_levels': list(),
-            'threshold': list()
+            'threshold': list(),
+            # Set when the lattice is found to be periodic from
+            # cycle_round on (period 1 being a fixed point)
+            'cycle_period': None,
+            'cycle_round': None
         }
 
+    def float_dtype(self):
+        """Return the dtype of the score and threshold lattices."""
+        dtype = np.dtype(self.config.get('float_dtype', 'float64'))
+        if dtype.kind != 'f':
+            raise SimulationException("float_dtype must be a floating "
+                                      "point type, not '%s'" % dtype)
+        return dtype
+
     def init_lattices(self):
-        rounds, scores, thresholds = Lattice(self.size),\
-                                     Lattice(self.size), Lattice(self.size)
+        """Return the (rounds, scores, thresholds, intuitive_actions)
+        lattices. Action lattices only hold ACTIONS values."""
+        if self.engine() == 'bitpacked':
+            return self.init_bit_lattices()
+        if self.engine() == 'tiled':
+            return self.init_tiled_lattices()
+        lattices = Lattice(self.size, ACTION_DTYPE), \
+                   Lattice(self.size, self.float_dtype()), \
+                   Lattice(self.size, self.float_dtype()), \
+                   Lattice(self.size, ACTION_DTYPE)
         # Create current and previous matrix,
         # to be used with Lattice.reset_current()
-        rounds.add_matrix()
-        rounds.add_matrix()
-        scores.add_matrix()
-        scores.add_matrix()
-        thresholds.add_matrix()
-        thresholds.add_matrix()
-        return rounds, scores, thresholds
+        for lattice in lattices:
+            lattice.add_matrix()
+            lattice.add_matrix()
+        return lattices
+
+    def init_bit_lattices(self):
+        """Return the lattices of the 'bitpacked' engine: the packed
+        actions, and as scores the bit-sliced number of cooperating
+        neighbors of each cell (see bitpacked_score_table). The thresholds
+        and intuitive actions, always 0 with 'assign2', are packed too."""
+        planes = max(self.topology.max_degree(), 1).bit_length()
+        lattices = BitLattice(self.size), \
+                   BitLattice(self.size, planes=planes), \
+                   BitLattice(self.size), \
+                   BitLattice(self.size)
+        for lattice in lattices:
+            lattice.add_matrix()
+            lattice.add_matrix()
+        return lattices
+
+    def init_tiled_lattices(self):
+        """Return the lattices of the 'tiled' engine, stored in
+        results_dir/simu_*/tiles."""
+        lattices = tuple(TiledLattice(self.size, dtype,
+                                      self.results_tiles_dir(), name,
+                                      self.tile_size())
+                         for name, dtype in (
+                             ('rounds', ACTION_DTYPE),
+                             ('scores', self.float_dtype()),
+                             ('thresholds', self.float_dtype()),
+                             ('intuitive_actions', ACTION_DTYPE)))
+        for lattice in lattices:
+            lattice.add_matrix()
+            lattice.add_matrix()
+        return lattices
 
     def build_payoff(self):
         if self.config['simulation_type'] == 'assign2':
@@ -206,7 +1697,7 @@ class Simulation:
                     'name': self.config['game']['name']}
         elif self.config['simulation_type'] == 'gamma':
             gamma_p = self.config['gamma_p']
-            choice = np.random.choice([0, 1], p=[1 - gamma_p, gamma_p])
+            choice = self.rng.choice([0, 1], p=[1 - gamma_p, gamma_p])
             game = self.config['gamma'][choice]
             TRPS = game['payoff']
             C, D = ACTIONS['C']['value'], ACTIONS['D']['value']
@@ -218,14 +1709,113 @@ class Simulation:
                                       "for simulation_type %s" %
                                       self.config['simulation_type'])
 
-    def neighbors(self, i, j):
-        if self.config['neighbor_type'] == 'moore':
-            return Neighbor.moore(i, j, self.size, self.size)
-        elif self.config['neighbor_type'] == 'von_neumann':
-            return Neighbor.von_neumann(i, j, self.size, self.size)
+    def build_payoff_matrix(self):
+        """Return self.payoff as a 2x2 array indexed by action values."""
+        C, D = ACTIONS['C']['value'], ACTIONS['D']['value']
+        matrix = np.zeros((2, 2))
+        for player_action in (C, D):
+            for neighbor_action in (C, D):
+                matrix[player_action, neighbor_action] = \
+                    self.payoff[player_action][neighbor_action]
+        return matrix
+
+    def engine(self):
+        return self.config.get('engine', 'loop')
+
+    def tile_size(self):
+        return self.config.get('tile_size', 1024)
+
+    def build_topology(self):
+        """Return the Topology of the lattice, or the Graph named by
+        config.graph. Generated graphs are drawn from config.graph_seed,
+        so that every simulation of a run plays on the same graph."""
+        graph = self.config.get('graph')
+        if graph is None:
+            # The bitpacked, tiled and threaded engines only need the
+            # offsets
+            return Topology(self.size, self.config['neighbor_type'],
+                            self.config.get('neighbor_radius', 1),
+                            self.config.get('periodic', True),
+                            self.engine() not in ('bitpacked', 'tiled',
+                                                  'threaded'))
+        degree = self.config.get('graph_degree', 4)
+        rng = np.random.default_rng(self.config.get('graph_seed', 0))
+        if graph == 'file':
+            return Graph.load(self.size, self.config['graph_file'])
+        elif graph == 'random_regular':
+            return Graph.random_regular(self.size, degree, rng)
+        elif graph == 'small_world':
+            return Graph.small_world(self.size, degree,
+                                     self.config.get('graph_rewiring', 0.1),
+                                     rng)
+        elif graph == 'scale_free':
+            return Graph.scale_free(self.size, degree, rng)
         else:
-            raise SimulationException("Unknown neighbor_type" \
-                                      ": '%s'" % self.config['neighbor_type'])
+            raise SimulationException("Unknown graph: '%s'" % graph)
+
+    def compile_rules(self):
+        """Resolve the rules named in the config, once, into the bound
+        methods playing the cells (start_rule and update_rule, with their
+        whole lattice versions), and cache the
+        config values they use, so that cells are played without any
+        config lookup."""
+        config = self.config
+        simulation_type = config['simulation_type']
+        if simulation_type not in ('assign2', 'gamma'):
+            raise SimulationException("Unknown simulation type %s" %
+                                      simulation_type)
+        self.start_coop_probability = config['start_coop_probability']
+        self.cell_rule = None
+        if simulation_type == 'gamma':
+            for game in config['gamma']:
+                if game['name'] not in Simulation.DELIBERATE_ACTIONS:
+                    raise SimulationException("Unknown game name: %s"
+                                              % game['name'])
+            return
+        starts = {
+            'probability': (self.play_random, self.play_random_lattice),
+            'middle_cluster': (self.play_middle_cluster,
+                               self.play_middle_cluster_lattice)
+        }
+        updates = {
+            'unconditional_imitation': (
+                self.play_unconditional_imitation,
+                self.play_unconditional_imitation_lattice),
+            'replicator_rule': (self.play_replicator_rule,
+                                self.play_replicator_rule_lattice),
+            'fermi_rule': (self.play_fermi_rule, self.play_fermi_rule_lattice)
+        }
+        if config['start_method'] not in starts:
+            raise SimulationException("Unknown start "
+                                      "method: '%s'" % config['start_method'])
+        if self.update_mechanism() not in updates:
+            raise SimulationException("Unknown update "
+                                      "mechanism: '%s'" % self.update_mechanism())
+        self.start_rule, self.start_rule_lattice = \
+            starts[config['start_method']]
+        self.update_rule, self.update_rule_lattice = \
+            updates[self.update_mechanism()]
+        payoff = config['game']['payoff']
+        self.payoff_range = max(payoff) - min(payoff)
+        self.fermi_temperature = config.get('fermi_temperature', 0.1)
+        if self.fermi_temperature <= 0:
+            raise SimulationException("fermi_temperature must be > 0, got %s"
+                                      % self.fermi_temperature)
+        if config['start_method'] == 'middle_cluster':
+            self.cluster_action = config['middle_cluster_action']
+            self.random_cluster = config['random_cluster']
+            cluster_size = config['middle_cluster_size']
+            center = self.size // 2
+            self.cluster = range(center - cluster_size, center + cluster_size)
+
+    def neighbors(self, i, j):
+        """Return the neighbor cells of (i, j), as flat indexes."""
+        return self.topology.cell_neighbors(self.topology.cell(i, j))
+
+    def plots(self):
+        """Return False in headless mode (config.plots): no figure nor
+        snapshot is rendered, only the numeric outputs are written."""
+        return self.config.get('plots', True)
 
     def plot_coop_levels(self):
         message = "Plot cooperation level"
@@ -250,18 +1840,6 @@ class Simulation:
 
     def plot_current(self):
         """Plot the self.rounds.current() matrix."""
-        # NOTE from_level_colors will color blue between 0, 1 and
-        # red between 1 and 2, there is maybe a better way for discrete values.
-        levels = [0, 1, 2]
-        colors = [ACTIONS['C']['color'], ACTIONS['D']['color']]
-        cmap, norm = mpl.colors.from_levels_and_colors(levels, colors)
-        fig = plt.matshow(self.rounds.current(), cmap=cmap, norm=norm)
-        if not self.config['show_axis']:
-            fig.axes.get_xaxis().set_visible(False)
-            fig.axes.get_yaxis().set_visible(False)
-            plt.axis('off')
-        if self.config['show_color_bar']:
-            plt.colorbar()
         if self.config['time_visualize_all']:
             # print replacing to avoid too much output
             print("\rPlot t{0} {1} ( coop {2}% )".format(self.t,
@@ -270,8 +1848,12 @@ class Simulation:
             if self.t == self.nround() - 1: print()
         else:
             log.debug("Plot t%d in '%s'" % (self.t, self.results_fig()))
-        plt.savefig(self.results_fig(), bbox_inches='tight')
-        plt.close()
+        if self.renderer is None:
+            # Outside of run(), render synchronously
+            SnapshotRenderer({**self.config, 'render_workers': 0}).submit(
+                self.current_actions(), self.results_fig())
+        else:
+            self.renderer.submit(self.current_actions(), self.results_fig())
 
     def nround(self):
         """Return the number of rounds played.
@@ -289,6 +1871,9 @@ class Simulation:
             self._results_dir += time.strftime('%H:%M:%S')
         else:
             self._results_dir += str(self.simuid)
+        if self.config.get('resume', False) \
+                and os.path.isdir(self.results_dir()):
+            return
         EvoDynUtils.mkdir(self.results_dir())
 
     def results_dir(self):
@@ -300,6 +1885,21 @@ class Simulation:
     def results_coop_fig(self):
         return os.path.join(self.results_dir(), "coop")
 
+    def results_trajectory_dir(self):
+        return os.path.join(self.results_dir(), "trajectory")
+
+    def results_tiles_dir(self):
+        return os.path.join(self.results_dir(), "tiles")
+
+    def results_checkpoint(self):
+        return os.path.join(self.results_dir(), 'checkpoint.npz')
+
+    def results_instrumentation(self):
+        return os.path.join(self.results_dir(), 'instrumentation.json')
+
+    def results_gif(self):
+        return os.path.join(self.results_dir(), "rounds.gif")
+
     def results_int_coop_fig(self):
         return os.path.join(self.results_dir(), "int_coop")
 
@@ -312,135 +1912,682 @@ class Simulation:
     def update_mechanism(self):
         return self.config['update_mechanism']
 
-    def play_random(self, return_action=False):
+    def draw_round(self):
+        """Draw the random numbers used by the cells in this round, with
+        one generator call per lattice. Cells read them by index from
+        self.draws, so that every engine consumes the same numbers."""
+        npeople = self.npeople()
+        self.draws = {}
+        if self.t == 0:
+            # The 'tiled' and 'bitpacked' engines draw them a few rows at
+            # a time (see start_rows)
+            if self.engine() not in ('tiled', 'bitpacked'):
+                self.draws['start'] = self.draw('random', npeople)
+            if self.config['simulation_type'] == 'gamma':
+                a, b = self.config['threshold_dist']
+                self.draws['threshold'] = self.draw('uniform', a, b, npeople)
+        elif self.config['simulation_type'] == 'assign2' \
+                and self.update_mechanism() in ('replicator_rule',
+                                                'fermi_rule'):
+            # Cells without neighbors draw (and ignore) a 0
+            self.draws['neighbor'] = self.draw(
+                'integers', np.maximum(self.topology.degree, 1))
+            self.draws['accept'] = self.draw('random', npeople)
+
+    def draw(self, method, *args):
+        """Return the numbers drawn by the self.rng method."""
+        return getattr(self.rng, method)(*args)
+
+    def cell_draw(self, name, i, j):
+        return self.draws[name][self.topology.cell(i, j)]
+
+    def play_random(self, i, j, return_action=False):
         """Play cooperate or defect based on config.start_coop_probability."""
-        coop_prob = self.config['start_coop_probability']
-        choice = np.random.choice(['C', 'D'], p=[coop_prob, 1 - coop_prob])
+        choice = 'C' if self.cell_draw('start', i, j) \
+            < self.start_coop_probability else 'D'
         if return_action:
             return choice
         else:
             return ACTIONS[choice]['value']
 
-    def play_unconditional_imitation(self, i, j):
-        previous_score = self.scores.previous()
-        previous_round = self.rounds.previous()
+    def best_neighbor(self, i, j):
+        """Return the cell with the best previous score among (i, j)
+        and its neighbors. Ties are won by (i, j) first, then by the
+        first neighbor."""
+        # TODO >= or > for unconditional_imitation
+        previous_score = self.scores.previous().reshape(-1)
+        cell = self.topology.cell(i, j)
         neighbors = self.neighbors(i, j)
-        best_action, best_score = previous_round[i, j], previous_score[i, j]
-        for ni, nj in neighbors:
-            # TODO >= or > for unconditional_imitation
-            if previous_score[ni, nj] > best_score:
-                best_action = previous_round[ni, nj]
-                best_score = previous_score[ni, nj]
-        return best_action
+        if len(neighbors) == 0:
+            return cell
+        neighbor_scores = previous_score[neighbors]
+        best = np.argmax(neighbor_scores)
+        if neighbor_scores[best] > previous_score[cell]:
+            return neighbors[best]
+        return cell
+
+    def play_unconditional_imitation(self, i, j):
+        previous_round = self.rounds.previous().reshape(-1)
+        return previous_round[self.best_neighbor(i, j)]
 
     def play_unconditional_imitation_with_threshold(self, i, j):
-        previous_score = self.scores.previous()
-        previous_intuitive_actions = self.intuitive_actions.previous()
-        previous_threshold = self.thresholds.previous()
+        previous_intuitive_actions = self.intuitive_actions.previous().reshape(-1)
+        previous_threshold = self.thresholds.previous().reshape(-1)
+        best = self.best_neighbor(i, j)
+        return previous_intuitive_actions[best], previous_threshold[best]
+
+    def replicator_probability(self, difference, degree):
+        """Return the probability to imitate a neighbor whose previous
+        score is higher by difference (wj - wi), for a cell with degree
+        neighbors. Computed in the dtype of the scores."""
+        denominator = np.asarray(degree * self.payoff_range,
+                                 dtype=difference.dtype)
+        return (1 + difference / denominator) / 2
+
+    def fermi_probability(self, difference, degree):
+        """Return the probability to imitate a neighbor whose previous
+        score is higher by difference (pairwise comparison with the Fermi
+        function at temperature fermi_temperature)."""
+        with np.errstate(over='ignore'):
+            return 1 / (1 + np.exp(-difference / self.fermi_temperature))
+
+    def play_stochastic_imitation(self, i, j, probability):
+        """Imitate the neighbor drawn by (i, j) with the probability
+        returned by probability(wj - wi, N)."""
+        # Following the same notation as the specifications
+        previous_score = self.scores.previous().reshape(-1)
+        previous_round = self.rounds.previous().reshape(-1)
+        cell = self.topology.cell(i, j)
         neighbors = self.neighbors(i, j)
-        best_action, best_score = previous_intuitive_actions[i, j], previous_score[i, j]
-        best_threshold = previous_threshold[i, j]
-        for ni, nj in neighbors:
-            # TODO >= or > for unconditional_imitation
-            if previous_score[ni, nj] > best_score:
-                best_action = previous_intuitive_actions[ni, nj]
-                best_score = previous_score[ni, nj]
-                best_threshold = previous_threshold[ni, nj]
-        return best_action, best_threshold
+        N = len(neighbors)
+        if N == 0:
+            return previous_round[cell]
+        neighbor = neighbors[self.cell_draw('neighbor', i, j)]
+        wi, wj = previous_score[cell], previous_score[neighbor]
+        if self.cell_draw('accept', i, j) < probability(wj - wi, N):
+            return previous_round[neighbor]
+        return previous_round[cell]
 
     def play_replicator_rule(self, i, j):
-        # Following the same notation as the specifications
-        # TODO check that it is working as expected
-        neighbors = self.neighbors(i, j)
-        neighbor, N = random.choice(neighbors), len(neighbors)
-        maxpayoff = max(self.config['game']['payoff'])
-        minpayoff = min(self.config['game']['payoff'])
-        wi, wj = self.scores.previous()[i, j], self.scores.previous()[neighbor]
-        p = (1 + (wj - wi) / (N * (maxpayoff - minpayoff))) / 2
-        return np.random.choice([self.rounds.previous()[neighbor],
-                                 self.rounds.previous()[i, j]], p=[p, 1 - p])
+        return self.play_stochastic_imitation(i, j,
+                                              self.replicator_probability)
+
+    def play_fermi_rule(self, i, j):
+        return self.play_stochastic_imitation(i, j, self.fermi_probability)
 
     def play_mechanism(self, i, j):
-        if self.is_update_mechanism('unconditional_imitation'):
-            return self.play_unconditional_imitation(i, j)
-        elif self.is_update_mechanism('replicator_rule'):
-            return self.play_replicator_rule(i, j)
-        else:
-            raise SimulationException("Unknown update " \
-                                      "mechanism: '%s'" % self.update_mechanism())
+        return self.update_rule(i, j)
 
     def play_middle_cluster(self, i, j):
-        cluster_action = self.config['middle_cluster_action']
-        if self.config['random_cluster']:
-            action = self.play_random(return_action=True)
+        cluster_action = self.cluster_action
+        if self.random_cluster:
+            action = self.play_random(i, j, return_action=True)
         else:
             action = cluster_action
         oppaction = EvoDynUtils.opposite_action(cluster_action)
-        cluster_size = self.config['middle_cluster_size']
-        center = self.size // 2
-        cluster = range(center - cluster_size, center + cluster_size)
+        cluster = self.cluster
         if i in cluster and j in cluster:
             return ACTIONS[action]['value']
         return ACTIONS[oppaction]['value']
 
-    def play_first(self, i, j):
-        if self.config['start_method'] == 'probability':
-            return self.play_random()
-        elif self.config['start_method'] == 'middle_cluster':
-            return self.play_middle_cluster(i, j)
+    def play_random_lattice(self, rows=None):
+        """Vectorized play_random for the whole lattice, or for the given
+        range of rows, whose draws are then the ones in draws['start']."""
+        start = self.draws['start']
+        start = start.reshape(start.shape[:-1] + (-1, self.size))
+        return np.where(start < self.start_coop_probability,
+                        ACTION_DTYPE(ACTIONS['C']['value']),
+                        ACTION_DTYPE(ACTIONS['D']['value']))
+
+    def play_middle_cluster_lattice(self, rows=None):
+        if rows is None:
+            rows = range(self.size)
+        cluster_action = self.config['middle_cluster_action']
+        oppaction = EvoDynUtils.opposite_action(cluster_action)
+        if self.config['random_cluster']:
+            actions = self.play_random_lattice(rows)
+        else:
+            actions = np.full((len(rows), self.size),
+                              ACTIONS[cluster_action]['value'], ACTION_DTYPE)
+        cluster_size = self.config['middle_cluster_size']
+        center = self.size // 2
+        cluster = np.zeros(self.size, dtype=bool)
+        cluster[max(center - cluster_size, 0):center + cluster_size] = True
+        in_cluster = np.outer(cluster[rows.start:rows.stop], cluster)
+        return np.where(in_cluster, actions,
+                        ACTION_DTYPE(ACTIONS[oppaction]['value']))
+
+    def play_first_lattice(self, rows=None):
+        return self.start_rule_lattice(rows)
+
+    def start_rows(self, ncells):
+        """Yield the ranges of about ncells cells worth of rows the start
+        rule is played on, a few rows at a time, drawing draws['start']
+        for each range in turn: the same numbers as drawing them at once."""
+        nrows = max(ncells // self.size, 1)
+        for start in range(0, self.size, nrows):
+            rows = range(start, min(start + nrows, self.size))
+            self.draws['start'] = self.draw('random', len(rows) * self.size)
+            yield rows
+
+    @staticmethod
+    def flat(matrix):
+        """Return a view of matrix with its last two (lattice) axes
+        flattened into an axis indexed by cell."""
+        return matrix.reshape(matrix.shape[:-2] + (-1,))
+
+    def best_neighbor_lattice(self, cells=None):
+        """Vectorized best_neighbor: the cell with the best previous
+        score among each cell and its neighbors, for every cell or for
+        the given cells only. Neighbors are compared one column at a
+        time with a strict '>', so that ties are won as in the per-cell
+        rule."""
+        if self.topology.neighbors is None:
+            return self.best_neighbor_graph(cells)
+        previous_score = Simulation.flat(self.scores.previous())
+        topology = self.topology
+        if cells is None:
+            cells = np.arange(topology.npeople(), dtype=np.int32)
+            neighbors, mask = topology.neighbors, topology.mask
+        else:
+            neighbors, mask = topology.neighbors[cells], topology.mask[cells]
+        best_score = previous_score[..., cells]
+        best = np.broadcast_to(cells, best_score.shape).copy()
+        for k in range(neighbors.shape[1]):
+            neighbor_score = previous_score.take(neighbors[:, k], axis=-1)
+            better = neighbor_score > best_score
+            if not topology.complete:
+                better &= mask[:, k]
+            np.copyto(best_score, neighbor_score, where=better)
+            np.copyto(best, neighbors[:, k], where=better)
+        return best
+
+    def play_unconditional_imitation_lattice(self):
+        previous_round = Simulation.flat(self.rounds.previous())
+        best = self.best_neighbor_lattice()
+        return np.take_along_axis(previous_round, best,
+                                  axis=-1).reshape(self.rounds.shape)
+
+    def random_neighbor_lattice(self):
+        """Return the neighbor drawn by each cell (draws['neighbor']) from
+        its CSR row, cells without neighbors drawing themselves."""
+        topology = self.topology
+        cells = np.arange(topology.npeople())
+        draws = self.draws['neighbor']
+        if len(topology.indices) == 0:
+            return np.broadcast_to(cells, draws.shape)
+        positions = np.minimum(topology.indptr[:-1] + draws,
+                               len(topology.indices) - 1)
+        return np.where(topology.degree > 0, topology.indices[positions],
+                        cells)
+
+    def play_stochastic_imitation_lattice(self, probability):
+        """Vectorized play_stochastic_imitation: the drawn neighbors, the
+        imitation probabilities and their acceptance are computed for the
+        whole lattice at once."""
+        previous_round = Simulation.flat(self.rounds.previous())
+        previous_score = Simulation.flat(self.scores.previous())
+        neighbor = self.random_neighbor_lattice()
+        difference = np.take_along_axis(previous_score, neighbor, axis=-1) \
+            - previous_score
+        imitate = self.draws['accept'] < probability(
+            difference, np.maximum(self.topology.degree, 1))
+        actions = np.where(imitate, np.take_along_axis(previous_round,
+                                                       neighbor, axis=-1),
+                           previous_round)
+        return actions.reshape(self.rounds.shape)
+
+    def play_replicator_rule_lattice(self):
+        return self.play_stochastic_imitation_lattice(
+            self.replicator_probability)
+
+    def play_fermi_rule_lattice(self):
+        return self.play_stochastic_imitation_lattice(self.fermi_probability)
+
+    def play_mechanism_lattice(self):
+        return self.update_rule_lattice()
+
+    def play_lattice(self):
+        if self.t == 0:
+            return self.play_first_lattice()
+        else:
+            return self.play_mechanism_lattice()
+
+    def calculate_score_lattice(self, out, cells=None):
+        """Vectorized calculate_score, writing the scores in out, for
+        every cell or only for the given cells.
+        Neighbors are summed in the same order as the per-cell rule."""
+        if self.topology.neighbors is None:
+            return self.calculate_score_graph(out, cells)
+        current_round = Simulation.flat(self.rounds.current())
+        # payoff[player, neighbor] is payoff[2 * player + neighbor]
+        payoff = self.build_payoff_matrix().reshape(-1)
+        topology = self.topology
+        if cells is None:
+            neighbors, mask = topology.neighbors, topology.mask
+            player_round = current_round.astype(np.intp) * 2
         else:
-            raise SimulationException("Unknown start " \
-                                      "method: '%s'" % self.config['start_method'])
+            neighbors, mask = topology.neighbors[cells], topology.mask[cells]
+            player_round = current_round[..., cells].astype(np.intp) * 2
+        scores = np.zeros(player_round.shape, dtype=out.dtype)
+        for k in range(neighbors.shape[1]):
+            neighbor_payoff = payoff.take(
+                player_round + current_round.take(neighbors[:, k], axis=-1))
+            if topology.complete:
+                np.add(scores, neighbor_payoff, out=scores)
+            else:
+                np.add(scores, neighbor_payoff, out=scores,
+                       where=mask[:, k])
+        if cells is None:
+            Simulation.flat(out)[...] = scores
+        else:
+            Simulation.flat(out)[..., cells] = scores
+        return out
+
+    def best_neighbor_graph(self, cells=None):
+        """best_neighbor_lattice on a Graph: the best neighbor of each
+        cell is the first edge reaching the maximum of its CSR segment
+        (segment reductions over the edges), kept if strictly better
+        than the cell itself."""
+        previous_score = Simulation.flat(self.scores.previous())
+        if cells is None:
+            cells = np.arange(self.topology.npeople(), dtype=np.int32)
+        indptr, neighbors = self.topology.edges(cells)
+        best_score = previous_score[..., cells]
+        best = np.broadcast_to(cells, best_score.shape).copy()
+        degree = np.diff(indptr)
+        connected = np.flatnonzero(degree)
+        if len(connected) == 0:
+            return best
+        starts = indptr[connected]
+        edge_score = previous_score.take(neighbors, axis=-1)
+        max_score = np.maximum.reduceat(edge_score, starts, axis=-1)
+        is_max = edge_score == np.repeat(max_score, degree[connected],
+                                         axis=-1)
+        first = np.minimum.reduceat(
+            np.where(is_max, np.arange(len(neighbors)), len(neighbors)),
+            starts, axis=-1)
+        better = max_score > best_score[..., connected]
+        best[..., connected] = np.where(better, neighbors[first],
+                                        best[..., connected])
+        return best
+
+    def calculate_score_graph(self, out, cells=None):
+        """calculate_score_lattice on a Graph, summing the payoffs of
+        each CSR segment with np.add.reduceat. Its summation order may
+        differ from the per-cell rule for non integer payoffs."""
+        current_round = Simulation.flat(self.rounds.current())
+        payoff = self.build_payoff_matrix().reshape(-1)
+        if cells is None:
+            cells = np.arange(self.topology.npeople(), dtype=np.int32)
+        indptr, neighbors = self.topology.edges(cells)
+        degree = np.diff(indptr)
+        players = np.repeat(cells, degree)
+        edge_payoff = payoff.take(
+            current_round.take(players, axis=-1).astype(np.intp) * 2
+            + current_round.take(neighbors, axis=-1))
+        scores = np.zeros(current_round.shape[:-1] + (len(cells),),
+                          dtype=out.dtype)
+        connected = np.flatnonzero(degree)
+        if len(connected):
+            scores[..., connected] = np.add.reduceat(
+                edge_payoff, indptr[connected], axis=-1)
+        Simulation.flat(out)[..., cells] = scores
+        return out
+
+    def incremental(self):
+        return self.config.get('incremental', False)
+
+    def update_dirty_cells(self):
+        """Store the cells whose action or score changed this round."""
+        rounds, scores = self.rounds, self.scores
+        self.dirty = np.flatnonzero((rounds.current() != rounds.previous()) |
+                                    (scores.current() != scores.previous()))
+
+    def play_incremental_lattice(self, current_round, current_score):
+        """Play and score the current round, only updating the cells
+        whose neighborhood changed in the previous round (self.dirty).
+
+        With unconditional imitation, a cell whose neighbors kept their
+        action and score plays its previous action again, and a cell
+        whose neighbors kept their action keeps its score.
+        """
+        previous_round = self.rounds.previous().reshape(-1)
+        previous_score = self.scores.previous().reshape(-1)
+        rounds, scores = current_round.reshape(-1), current_score.reshape(-1)
+        rounds[...] = previous_round
+        scores[...] = previous_score
+        updated = self.topology.closed_neighborhood(self.dirty)
+        rounds[updated] = previous_round[self.best_neighbor_lattice(updated)]
+        changed = updated[rounds[updated] != previous_round[updated]]
+        rescored = self.topology.closed_neighborhood(changed)
+        self.calculate_score_lattice(current_score, rescored)
+        self.dirty = np.union1d(changed, rescored[
+            scores[rescored] != previous_score[rescored]])
+
+    def check_incremental_lattice(self, current_round, current_score):
+        """Compare the incremental round with a full recomputation."""
+        expected_score = np.empty_like(current_score)
+        self.calculate_score_lattice(expected_score)
+        if not np.array_equal(self.play_lattice(), current_round) \
+                or not np.array_equal(expected_score, current_score):
+            raise SimulationException("Incremental round t%d differs from "
+                                      "the full recomputation" % self.t)
+
+    def play_and_score_lattice(self, current_round, current_score):
+        """Play and score the current round with the vectorized rules.
+        In incremental mode, the full rules are still used for the first
+        rounds, and while too many cells change to be worth tracking."""
+        if self.incremental() and self.t >= 2 and len(self.dirty) <= \
+                Simulation.INCREMENTAL_MAX_DIRTY * self.npeople():
+            self.play_incremental_lattice(current_round, current_score)
+            if self.config.get('incremental_check', False):
+                self.check_incremental_lattice(current_round, current_score)
+            return
+        current_round[...] = self.play_lattice()
+        self.calculate_score_lattice(current_score)
+        if self.incremental():
+            self.update_dirty_cells()
+
+    def bitpacked_score_table(self):
+        """Return the (2, k + 1) scores of a cell by action and number of
+        cooperating neighbors, k being the number of neighbors. Payoffs
+        are integers (see check_engine), so that they are exactly the
+        per-cell sums: with other payoffs, tied scores could be rounded
+        apart differently and break the ties of the other engines."""
+        payoff = self.build_payoff_matrix()
+        C, D = ACTIONS['C']['value'], ACTIONS['D']['value']
+        k = len(self.topology.offsets)
+        ncoop = np.arange(k + 1)
+        table = np.empty((2, k + 1))
+        for action in (C, D):
+            table[action] = ncoop * payoff[action, C] \
+                            + (k - ncoop) * payoff[action, D]
+        return table.astype(self.float_dtype())
+
+    def bitpacked_scores(self):
+        """Return the current scores of the 'bitpacked' engine, as a
+        (size, size) matrix."""
+        return self.bitpacked_score_table()[
+            self.current_actions(), self.scores.unpack(self.scores.current())]
+
+    def score_ranks_bitpacked(self, actions, counts):
+        """Return the bit planes of the rank of the score of each cell
+        among the possible scores, equal scores having the same rank,
+        from the packed actions and cooperating neighbor counts."""
+        lattice = self.rounds
+        table = self.bitpacked_score_table()
+        values, ranks = np.unique(table, return_inverse=True)
+        ranks = ranks.reshape(table.shape)
+        planes = [np.zeros(lattice.shape, dtype=np.uint64)
+                  for _ in range(max(len(values) - 1, 1).bit_length())]
+        not_counts = [~plane for plane in counts]
+        for action in (ACTIONS['C']['value'], ACTIONS['D']['value']):
+            players = lattice.cells(actions, action)
+            for ncoop in range(table.shape[1]):
+                cells = players.copy()
+                for b, plane in enumerate(counts):
+                    cells &= plane if ncoop >> b & 1 else not_counts[b]
+                for b, plane in enumerate(planes):
+                    if ranks[action, ncoop] >> b & 1:
+                        plane |= cells
+        return planes
+
+    def play_bitpacked(self):
+        """Bit-packed play of the current round: the start rule, packed
+        a few rows at a time, at t0, then unconditional imitation. The
+        score ranks of the neighbors are compared to the best one so far
+        with a strict '>', one neighbor offset at a time, as
+        best_neighbor_lattice."""
+        lattice = self.rounds
+        if self.t == 0:
+            current_round = lattice.current()
+            for rows in self.start_rows(Simulation.START_CHUNK_CELLS):
+                current_round[rows.start:rows.stop] = lattice.pack(
+                    self.play_first_lattice(rows))
+            return
+        previous_round = lattice.previous()
+        ranks = self.score_ranks_bitpacked(previous_round,
+                                           self.scores.previous())
+        best = [plane.copy() for plane in ranks]
+        best_action = previous_round.copy()
+        for dr, dc in self.topology.offsets:
+            neighbor = [lattice.shift(plane, dr, dc) for plane in ranks]
+            better = BitLattice.greater(neighbor, best)
+            for plane, neighbor_plane in zip(best, neighbor):
+                BitLattice.copy_where(plane, neighbor_plane, better)
+            BitLattice.copy_where(best_action,
+                                  lattice.shift(previous_round, dr, dc),
+                                  better)
+        lattice.current()[...] = best_action
+
+    def count_cooperators_bitpacked(self, actions, out):
+        """Write in out the bit planes of the number of cooperating
+        neighbors of each cell, adding the shifted cooperator bits of each
+        neighbor offset with bit-sliced ripple-carry adders."""
+        lattice = self.rounds
+        cooperators = lattice.cells(actions, ACTIONS['C']['value'])
+        out.fill(0)
+        for dr, dc in self.topology.offsets:
+            carry = lattice.shift(cooperators, dr, dc)
+            for plane in out:
+                overflow = plane & carry
+                plane ^= carry
+                carry = overflow
 
-    def play_gamma_first(self):
-        a, b = self.config['threshold_dist']
-        return self.play_random(), np.random.uniform(a, b)
+    @staticmethod
+    def read_cells(matrix, rows, cols):
+        """Return the rows x cols cells (index arrays) of a matrix or of
+        a TiledMatrix."""
+        if isinstance(matrix, TiledMatrix):
+            return matrix.read(rows, cols)
+        return matrix.take(rows, axis=0).take(cols, axis=1)
+
+    def tile_window(self, matrix, rows, cols, fill=0):
+        """Return (window, valid): the cells of the rows x cols (ranges)
+        tile of matrix with a halo of the neighbor radius around it,
+        wrapped around the torus, and None. On non-periodic lattices,
+        the halo cells out of the lattice are set to fill, and valid is
+        False for them."""
+        radius = self.topology.radius
+        window_rows = np.arange(rows.start - radius, rows.stop + radius)
+        window_cols = np.arange(cols.start - radius, cols.stop + radius)
+        if self.topology.periodic:
+            return Simulation.read_cells(matrix, window_rows % self.size,
+                                         window_cols % self.size), None
+        valid_rows = (window_rows >= 0) & (window_rows < self.size)
+        valid_cols = (window_cols >= 0) & (window_cols < self.size)
+        window = np.full((len(window_rows), len(window_cols)), fill,
+                         dtype=matrix.dtype)
+        window[np.ix_(valid_rows, valid_cols)] = Simulation.read_cells(
+            matrix, window_rows[valid_rows], window_cols[valid_cols])
+        return window, np.outer(valid_rows, valid_cols)
+
+    def tile_views(self, window, rows, cols):
+        """Return the views of window on the cells of the tile, then on
+        their neighbors, offset by offset."""
+        radius = self.topology.radius
+        return [window[radius + dr:radius + dr + len(rows),
+                       radius + dc:radius + dc + len(cols)]
+                for dr, dc in ((0, 0),) + self.topology.offsets]
+
+    def play_tile(self, rows, cols):
+        """Return the actions of the rows x cols tile in the current
+        round, played from the previous scores and actions of the tile
+        and its halo with unconditional imitation."""
+        scores, _ = self.tile_window(self.scores.previous(), rows, cols,
+                                     fill=-np.inf)
+        actions, _ = self.tile_window(self.rounds.previous(), rows, cols)
+        score_views = self.tile_views(scores, rows, cols)
+        action_views = self.tile_views(actions, rows, cols)
+        # Same scan as best_neighbor_lattice, missing neighbors
+        # never being better with a -inf score
+        best_score, best_action = score_views[0].copy(), \
+            action_views[0].copy()
+        for neighbor_score, neighbor_action in zip(score_views[1:],
+                                                   action_views[1:]):
+            better = neighbor_score > best_score
+            np.copyto(best_score, neighbor_score, where=better)
+            np.copyto(best_action, neighbor_action, where=better)
+        return best_action
+
+    def score_tile(self, rows, cols, payoff):
+        """Return the scores of the rows x cols tile in the current round,
+        from the current actions of the tile and its halo, payoff being
+        the flat payoff matrix. Neighbors are summed in the same order as
+        calculate_score_lattice."""
+        actions, valid = self.tile_window(self.rounds.current(), rows, cols)
+        action_views = self.tile_views(actions, rows, cols)
+        valid_views = [True] * len(action_views) if valid is None \
+            else self.tile_views(valid, rows, cols)
+        player_round = action_views[0].astype(np.intp) * 2
+        scores = np.zeros(player_round.shape,
+                          dtype=self.scores.current().dtype)
+        for neighbor_action, neighbor_valid in zip(action_views[1:],
+                                                   valid_views[1:]):
+            np.add(scores, payoff.take(player_round + neighbor_action),
+                   out=scores, where=neighbor_valid)
+        return scores
+
+    def play_tiled(self):
+        """Play the current round tile by tile, writing each tile of
+        the current actions from the previous scores and actions of the
+        tile and its halo. At t0, the start rule is played a few rows at
+        a time, drawing the same numbers as the other engines."""
+        current_round = self.rounds.current()
+        if self.t == 0:
+            for rows in self.start_rows(self.tile_size() ** 2):
+                current_round.write(rows, range(self.size),
+                                    self.play_first_lattice(rows))
+            return
+        for rows, cols in current_round.tiles():
+            current_round.write(rows, cols, self.play_tile(rows, cols))
+
+    def score_tiled(self):
+        """Score the current round tile by tile."""
+        payoff = self.build_payoff_matrix().reshape(-1)
+        current_score = self.scores.current()
+        for rows, cols in current_score.tiles():
+            current_score.write(rows, cols,
+                                self.score_tile(rows, cols, payoff))
+
+    def threads(self):
+        """Return the number of threads of the 'threaded' engine."""
+        return self.config.get('threads', 0) or os.cpu_count() or 1
+
+    def thread_pool(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads())
+        return self.executor
+
+    def stripes(self):
+        """Return the ranges of rows of the stripes updated by the
+        threads, one per thread."""
+        bounds = np.linspace(0, self.size, self.threads() + 1).astype(int)
+        return [range(start, stop)
+                for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    def play_threaded(self):
+        """Play the current round in row stripes, updated in parallel by
+        the threads of the pool with the tile rules, whose NumPy kernels
+        release the GIL. A stripe reads the rows of the neighbor stripes
+        in its halo from the previous matrices, which are only written
+        before the round, so that the result is the synchronous update."""
+        current_round = self.rounds.current()
+        if self.t == 0:
+            current_round[...] = self.play_first_lattice()
+            return
+
+        def play_stripe(rows):
+            current_round[rows.start:rows.stop] = \
+                self.play_tile(rows, range(self.size))
+        # Waiting for every stripe is the barrier before the scoring
+        list(self.thread_pool().map(play_stripe, self.stripes()))
+
+    def score_threaded(self):
+        """Score the current round in row stripes, once every stripe of
+        the current actions has been played."""
+        payoff = self.build_payoff_matrix().reshape(-1)
+        current_score = self.scores.current()
+
+        def score_stripe(rows):
+            current_score[rows.start:rows.stop] = \
+                self.score_tile(rows, range(self.size), payoff)
+        list(self.thread_pool().map(score_stripe, self.stripes()))
+
+    def play_first(self, i, j):
+        return self.start_rule(i, j)
+
+    def play_gamma_first(self, i, j):
+        return self.play_random(i, j), self.cell_draw('threshold', i, j)
+
+    def play_gamma_first_lattice(self):
+        """Vectorized play_gamma_first for the whole lattice."""
+        return self.play_random_lattice().reshape(-1), \
+               self.draws['threshold']
+
+    def play_gamma_round_compiled(self):
+        """Play the current gamma round with the compiled kernel."""
+        if self.t == 0:
+            first_int_actions, first_thresholds = \
+                self.play_gamma_first_lattice()
+        else:
+            first_int_actions = np.zeros(0, dtype=ACTION_DTYPE)
+            first_thresholds = np.zeros(0, dtype=self.float_dtype())
+        kernel = compiled(gamma_round_kernel)
+        kernel(self.t == 0, self.topology.indptr, self.topology.indices,
+               self.build_payoff_matrix(), self.cost, self.deliberate,
+               first_int_actions.astype(ACTION_DTYPE),
+               first_thresholds.astype(self.float_dtype()),
+               self.intuitive_actions.previous().reshape(-1),
+               self.thresholds.previous().reshape(-1),
+               self.scores.previous().reshape(-1),
+               self.intuitive_actions.current().reshape(-1),
+               self.thresholds.current().reshape(-1),
+               self.rounds.current().reshape(-1),
+               self.scores.current().reshape(-1))
 
     def generate_cost(self):
         a, b = self.config['cost_dist']
-        z = np.random.uniform(a, b)
+        z = self.rng.uniform(a, b)
         return 1 - (1 / (1 + z) ** 4)
 
     def deliberate_action(self):
-        if self.payoff['name'] == 'coordination game':
-            return ACTIONS['C']['value']
-        elif self.payoff['name'] == 'prisoners dilemma':
-            return ACTIONS['D']['value']
-        else:
+        if self.payoff['name'] not in Simulation.DELIBERATE_ACTIONS:
             raise SimulationException("Unknown game name: %s" % self.payoff['name'])
+        return Simulation.DELIBERATE_ACTIONS[self.payoff['name']]
 
     def play(self, i, j):
-        if self.config['simulation_type'] == 'gamma':
-            return self.play_gamma(i, j)
-        elif self.t == 0:
-            return self.play_first(i, j)
-        else:
-            return self.play_mechanism(i, j)
+        """Play (i, j) with the rule of the current round, set by
+        start_round."""
+        return self.cell_rule(i, j)
 
     def calculate_score(self, i, j):
         current_round = self.rounds.current()
-        neighbors = self.neighbors(i, j)
+        neighbor_actions = current_round.reshape(-1)[self.neighbors(i, j)]
         score = 0
-        player_action = current_round[i, j]
-        for ni, nj in neighbors:
-            neighbor_action = current_round[ni, nj]
-            score += self.payoff[player_action][neighbor_action]
+        payoff = self.payoff[current_round[i, j]]
+        for neighbor_action in neighbor_actions:
+            score += payoff[neighbor_action]
         return score
 
     def calculate_score_with_deliberation(self, i, j):
         current_round = self.rounds.current()
-        neighbors = self.neighbors(i, j)
-        score = self.scores.current()[i,j]
-        player_action = current_round[i, j]
-        for ni, nj in neighbors:
-            neighbor_action = current_round[ni, nj]
-            score += self.payoff[player_action][neighbor_action]
+        neighbor_actions = current_round.reshape(-1)[self.neighbors(i, j)]
+        score = self.scores.current()[i, j]
+        payoff = self.payoff[current_round[i, j]]
+        for neighbor_action in neighbor_actions:
+            score += payoff[neighbor_action]
         return score
 
     def npeople(self):
         """Return the number of people playing the game."""
         return self.size * self.size
 
+    def current_actions(self):
+        """Return the current (size, size) action matrix, unpacked."""
+        return self.rounds.unpack(self.rounds.current())
+
     def current_coop_percentage(self):
         ncoop = self.rounds.current_counts(ACTIONS['C']['value'])
         return round((ncoop / self.npeople()) * 100, 2)
@@ -450,12 +2597,7 @@ class Simulation:
         return round((ncoop / self.npeople()) * 100, 2)
 
     def current_threshold_mean(self):
-        mean = 0
-        current_threshold = self.thresholds.current()
-        for a in range(len(current_threshold)):
-            for b in range(len(current_threshold[a])):
-                mean += current_threshold[a][b]
-        return mean / self.npeople()
+        return self.thresholds.current_sum() / self.npeople()
 
     def gather_current_data(self):
         self._data['coop_levels'].append(self.current_coop_percentage())
@@ -463,31 +2605,283 @@ class Simulation:
             self.current_intuitive_coop_percentage())
         self._data['threshold'].append(self.current_threshold_mean())
 
-    def _run_simulation_assign2(self):
-        log.info("Starting 'assign2' simulation")
-        self.payoff = self.build_payoff()
-        if self.config['time_visualize_all']:
-            log.info("All rounds will be plotted")
-        for t in range(self.nround()):
+    def recorded_lattices(self):
+        """Return the lattices recorded each round, by name."""
+        lattices = {'rounds': self.rounds}
+        if self.config['simulation_type'] == 'gamma':
+            lattices['intuitive_actions'] = self.intuitive_actions
+            lattices['thresholds'] = self.thresholds
+        return lattices
+
+    def init_recorder(self, first_round=0):
+        if not self.config.get('record', False):
+            return None
+        lattices = self.recorded_lattices()
+        log.info("Recording %s in '%s'" % (', '.join(lattices),
+                                           self.results_trajectory_dir()))
+        return TrajectoryRecorder(
+            self.results_trajectory_dir(),
+            {name: lattice.value_dtype for name, lattice in lattices.items()},
+            (self.size, self.size), self.nround(),
+            self.config.get('record_chunk_rounds', 64),
+            self.config.get('record_compress', False), first_round)
+
+    def init_gif(self):
+        if not self.config.get('gif', False):
+            return None
+        log.info("Exporting rounds in '%s'" % self.results_gif())
+        return GifWriter(self.results_gif(), EvoDynUtils.actions_palette(),
+                         self.config.get('gif_delay', 10),
+                         self.config.get('gif_downscale', 1),
+                         self.config.get('gif_scale', 1))
+
+    def record_current(self):
+        self.recorder.record({name: lattice.unpack(lattice.current())
+                              for name, lattice
+                              in self.recorded_lattices().items()})
+
+    def end_round(self):
+        """Plot, gather and record the current round."""
+        if self.plots() and (self.config['time_visualize_all']
+                             or self.t in self.config['time_visualize']):
+            self.plot_current()
+        self.gather_current_data()
+        if self.recorder is not None:
+            self.record_current()
+        if self.gif is not None \
+                and self.t % self.config.get('gif_stride', 1) == 0:
+            self.gif.add_frame(self.current_actions())
+
+    def add_hook(self, event, callback):
+        """Call callback(simulation) on each event: 'on_round_start',
+        before the round is drawn, or 'on_round_end', once it is
+        played, scored and gathered."""
+        if event not in self.hooks:
+            raise SimulationException("Unknown hook event: '%s'" % event)
+        self.hooks[event].append(callback)
+
+    def call_hooks(self, event):
+        for callback in self.hooks[event]:
+            callback(self)
+
+    def checkpointing(self):
+        return self.checkpoint_rounds > 0 or self.checkpoint_seconds > 0
+
+    def init_checkpoints(self):
+        """Start the checkpoint timer and, in the main thread, catch
+        Ctrl-C to checkpoint the current round before stopping."""
+        self.last_checkpoint = time.monotonic()
+        if self.checkpointing() \
+                and threading.current_thread() is threading.main_thread():
+            self.sigint_handler = signal.signal(signal.SIGINT,
+                                                self.interrupt)
+
+    def interrupt(self, signum, frame):
+        log.warning("Interrupted, stopping after round t%d "
+                    "(Ctrl-C again to stop now)" % self.t)
+        self.interrupted = True
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    def write_checkpoint(self):
+        """Write the state of the simulation at the end of round self.t
+        in results_dir: lattices, data, and generator state. It is written
+        in a temporary file renamed over the previous checkpoint, so that
+        a checkpoint is never left half written."""
+        if self.recorder is not None:
+            self.recorder.flush()
+        arrays = {}
+        for name, lattice in (('rounds', self.rounds),
+                              ('scores', self.scores),
+                              ('thresholds', self.thresholds),
+                              ('intuitive_actions', self.intuitive_actions)):
+            for depth, matrix in enumerate(lattice.l):
+                arrays['%s_%d' % (name, depth)] = matrix
+        for key in ('coop_levels', 'int_coop_levels', 'threshold'):
+            arrays['data_' + key] = np.asarray(self._data[key],
+                                               dtype=np.float64)
+        if self.dirty is not None:
+            arrays['dirty'] = self.dirty
+        history = [] if self.cycle_detector is None else \
+            [(t, digest.hex()) for t, digest in self.cycle_detector.history]
+        arrays['meta'] = np.array(json.dumps({
+            't': self.t,
+            'rng': self.rng.bit_generator.state,
+            'cycle_period': self._data['cycle_period'],
+            'cycle_round': self._data['cycle_round'],
+            'cycle_history': history
+        }))
+        path = self.results_checkpoint()
+        temporary = path + '.tmp.npz'
+        np.savez_compressed(temporary, **arrays)
+        os.replace(temporary, path)
+        self.last_checkpoint = time.monotonic()
+        log.debug("Checkpoint t%d written in '%s'" % (self.t, path))
+
+    def resume_checkpoint(self):
+        """Load the checkpoint of results_dir, if any. Return the first
+        round left to play."""
+        path = self.results_checkpoint()
+        if not os.path.exists(path):
+            return 0
+        with np.load(path) as checkpoint:
+            meta = json.loads(str(checkpoint['meta']))
+            for name, lattice in (('rounds', self.rounds),
+                                  ('scores', self.scores),
+                                  ('thresholds', self.thresholds),
+                                  ('intuitive_actions',
+                                   self.intuitive_actions)):
+                for depth, matrix in enumerate(lattice.l):
+                    matrix[...] = checkpoint['%s_%d' % (name, depth)]
+            for key in ('coop_levels', 'int_coop_levels', 'threshold'):
+                self._data[key] = checkpoint['data_' + key].tolist()
+            if 'dirty' in checkpoint:
+                self.dirty = checkpoint['dirty']
+        self.t = meta['t']
+        self.rng.bit_generator.state = meta['rng']
+        self._data['cycle_period'] = meta['cycle_period']
+        self._data['cycle_round'] = meta['cycle_round']
+        if self.cycle_detector is not None:
+            for t, digest in meta['cycle_history']:
+                self.cycle_detector.history.append((t, bytes.fromhex(digest)))
+                self.cycle_detector.rounds[bytes.fromhex(digest)] = t
+        log.info("Resuming after round t%d from '%s'" % (self.t, path))
+        if self._data['cycle_period'] is not None:
+            return self.nround()
+        return self.t + 1
+
+    def checkpoint_round(self):
+        """Write a checkpoint of the round just played if one is due,
+        and stop the simulation if it was interrupted."""
+        if not self.checkpointing():
+            return
+        if self.interrupted \
+                or (self.checkpoint_rounds > 0
+                    and (self.t + 1) % self.checkpoint_rounds == 0) \
+                or (self.checkpoint_seconds > 0
+                    and time.monotonic() - self.last_checkpoint
+                    >= self.checkpoint_seconds):
+            self.write_checkpoint()
+        if self.interrupted:
+            raise KeyboardInterrupt
+
+    def cycle_detection(self):
+        return self.config.get('cycle_detection')
+
+    def init_cycle_detector(self):
+        if self.cycle_detection() is None:
+            return None
+        return CycleDetector(self.config.get('cycle_window', 8))
+
+    def fast_forward(self, period):
+        """Fill the data of the remaining rounds, knowing that the
+        lattice repeats itself every period rounds."""
+        for key in ('coop_levels', 'int_coop_levels', 'threshold'):
+            series = self._data[key]
+            while len(series) < self.nround():
+                series.append(series[-period])
+
+    def detect_cycle(self):
+        """Return True if the lattice reached a fixed point or a cycle,
+        and the remaining rounds do not have to be played."""
+        if self.cycle_detector is None:
+            return False
+        cycle = self.cycle_detector.update(self.t, self.rounds.current())
+        if cycle is None:
+            return False
+        first_round, period = cycle
+        self._data['cycle_round'], self._data['cycle_period'] = cycle
+        log.info("Period %d cycle reached at t%d (detected at t%d)"
+                 % (period, first_round, self.t))
+        if self.cycle_detection() == 'fast_forward':
+            self.fast_forward(period)
+        return True
+
+    def start_round(self, t):
+        """Start round t: draw its game (gamma), cost (gamma) and random
+        numbers, and make the current matrices the previous ones."""
+        if self.config['simulation_type'] == 'gamma':
+            # Update gamma game
+            self.payoff = self.build_payoff()
+            # log.info("Game for round %d: %s" % (t, self.payoff['name']))
             self.t = t
-            current_score = self.scores.reset_current()
-            current_round = self.rounds.reset_current()
+            self.cost = self.generate_cost()
+            self.deliberate = self.deliberate_action()
+            self.cell_rule = self.play_gamma
+            lattices = self.rounds, self.scores, self.thresholds, \
+                       self.intuitive_actions
+        else:
+            self.t = t
+            self.cell_rule = self.play_first if t == 0 \
+                else self.play_mechanism
+            lattices = self.rounds, self.scores
+        self.draw_round()
+        for lattice in lattices:
+            lattice.reset_current()
+
+    def play_round(self):
+        """Play the current assign2 round."""
+        current_round = self.rounds.current()
+        if self.engine() == 'vectorized':
+            current_round[...] = self.play_lattice()
+        elif self.engine() == 'bitpacked':
+            self.play_bitpacked()
+        elif self.engine() == 'tiled':
+            self.play_tiled()
+        elif self.engine() == 'threaded':
+            self.play_threaded()
+        else:
             for i in range(self.size):
                 for j in range(self.size):
                     current_round[i, j] = self.play(i, j)
+
+    def score_round(self):
+        """Score the current assign2 round."""
+        current_score = self.scores.current()
+        if self.engine() == 'vectorized':
+            self.calculate_score_lattice(current_score)
+        elif self.engine() == 'bitpacked':
+            self.count_cooperators_bitpacked(self.rounds.current(),
+                                             current_score)
+        elif self.engine() == 'tiled':
+            self.score_tiled()
+        elif self.engine() == 'threaded':
+            self.score_threaded()
+        else:
             for i in range(self.size):
                 for j in range(self.size):
                     current_score[i, j] = self.calculate_score(i, j)
-            if self.config['time_visualize_all'] \
-                    or t in self.config['time_visualize']:
-                self.plot_current()
-            self.gather_current_data()
-        self.plot_coop_levels()
+
+    def play_and_score_round(self):
+        if self.engine() == 'vectorized':
+            self.play_and_score_lattice(self.rounds.current(),
+                                        self.scores.current())
+        else:
+            self.play_round()
+            self.score_round()
+
+    def _run_simulation_assign2(self, first_round=0):
+        log.info("Starting 'assign2' simulation (%s engine)" % self.engine())
+        self.payoff = self.build_payoff()
+        if self.config['time_visualize_all']:
+            log.info("All rounds will be plotted")
+        for t in range(first_round, self.nround()):
+            self.t = t
+            self.call_hooks('on_round_start')
+            self.start_round(t)
+            self.play_and_score_round()
+            self.end_round()
+            self.call_hooks('on_round_end')
+            cycle = self.detect_cycle()
+            self.checkpoint_round()
+            if cycle:
+                break
+        if self.plots():
+            self.plot_coop_levels()
         log.info("Simulation finished!")
 
     def play_gamma(self, i, j):
         if self.t == 0:
-            action_and_thres = self.play_gamma_first()
+            action_and_thres = self.play_gamma_first(i, j)
             return action_and_thres
         else:
             action, threshold = self.play_unconditional_imitation_with_threshold(i, j)
@@ -497,41 +2891,106 @@ class Simulation:
         thresholds = self.thresholds.current()
         if self.cost <= thresholds[i, j]:
             current_score = self.scores.current()
-            current_score[i, j] -= self.cost * Neighbor.MOORE_NUMBER_OF_NEIGHBORS
-            action = self.deliberate_action()
+            cell = self.topology.cell(i, j)
+            current_score[i, j] -= self.cost * self.topology.degree[cell]
+            action = self.deliberate
         else:
             action = self.intuitive_actions.current()[i, j]
         return action
 
-    def _run_simulation_gamma(self):
-        log.info("Starting 'gamma' simulation")
+    def play_gamma_round(self):
+        """Play and score the current gamma round, in a single sweep."""
+        if self.engine() == 'compiled':
+            self.play_gamma_round_compiled()
+            return
+        current_score = self.scores.current()
+        current_round = self.rounds.current()
+        current_threshold = self.thresholds.current()
+        current_int_actions = self.intuitive_actions.current()
+        for i in range(self.size):
+            for j in range(self.size):
+                current_int_actions[i, j], current_threshold[i, j] \
+                    = self.play_gamma(i, j)
+                current_round[i, j] = self.play_deliberate(i, j)
+                current_score[i, j] = self.calculate_score_with_deliberation(i, j)
+
+    def _run_simulation_gamma(self, first_round=0):
+        log.info("Starting 'gamma' simulation (%s engine)" % self.engine())
         if self.config['time_visualize_all']:
             log.info("All rounds will be plotted")
-        for t in range(self.nround()):
-            # Update gamma game
-            self.payoff = self.build_payoff()
-            # log.info("Game for round %d: %s" % (t, self.payoff['name']))
+        for t in range(first_round, self.nround()):
             self.t = t
-            self.cost = self.generate_cost()
-            current_score = self.scores.reset_current()
-            current_round = self.rounds.reset_current()
-            current_threshold = self.thresholds.add_matrix()
-            current_int_actions = self.intuitive_actions.add_matrix()
-            for i in range(self.size):
-                for j in range(self.size):
-                    current_int_actions[i, j], current_threshold[i, j] \
-                        = self.play_gamma(i, j)
-                    current_round[i, j] = self.play_deliberate(i, j)
-                    current_score[i, j] = self.calculate_score_with_deliberation(i, j)
-            if self.config['time_visualize_all'] \
-                    or t in self.config['time_visualize']:
-                self.plot_current()
-            self.gather_current_data()
-        self.plot_coop_levels()
-        self.plot_int_coop_levels()
-        self.plot_mean_threshold()
+            self.call_hooks('on_round_start')
+            self.start_round(t)
+            self.play_gamma_round()
+            self.end_round()
+            self.call_hooks('on_round_end')
+            self.checkpoint_round()
+        if self.plots():
+            self.plot_coop_levels()
+            self.plot_int_coop_levels()
+            self.plot_mean_threshold()
         log.info("Simulation finished!")
 
+    def check_engine(self):
+        engines = {
+            'loop': ('assign2', 'gamma'),
+            'vectorized': ('assign2',),
+            'compiled': ('gamma',),
+            'bitpacked': ('assign2',),
+            'tiled': ('assign2',),
+            'threaded': ('assign2',)
+        }
+        if self.engine() not in engines:
+            raise SimulationException("Unknown engine: '%s'" % self.engine())
+        if self.config['simulation_type'] not in engines[self.engine()]:
+            raise SimulationException("The '%s' engine does not support "
+                                      "simulation_type %s" %
+                                      (self.engine(),
+                                       self.config['simulation_type']))
+        if self.engine() == 'bitpacked' and (
+                not self.is_update_mechanism('unconditional_imitation')
+                or not self.topology.complete):
+            raise SimulationException("The 'bitpacked' engine only supports "
+                                      "'unconditional_imitation' on "
+                                      "periodic lattices")
+        if self.engine() == 'bitpacked' and not all(
+                float(p).is_integer() for p in self.config['game']['payoff']):
+            raise SimulationException("The 'bitpacked' engine only supports "
+                                      "integer payoffs")
+        if self.engine() in ('tiled', 'threaded') and (
+                not self.is_update_mechanism('unconditional_imitation')
+                or not isinstance(self.topology, Topology)):
+            raise SimulationException("The '%s' engine only supports "
+                                      "'unconditional_imitation' on "
+                                      "lattices" % self.engine())
+        if self.engine() == 'tiled':
+            if self.checkpointing() or self.cycle_detection() is not None:
+                raise SimulationException("The 'tiled' engine does not "
+                                          "support checkpoints nor "
+                                          "cycle_detection")
+        if self.incremental() and (
+                self.engine() != 'vectorized'
+                or not self.is_update_mechanism('unconditional_imitation')):
+            raise SimulationException("incremental is only supported by "
+                                      "the 'vectorized' engine with "
+                                      "'unconditional_imitation'")
+        if self.cycle_detection() is not None:
+            if self.cycle_detection() not in ('stop', 'fast_forward'):
+                raise SimulationException("Unknown cycle_detection: '%s'"
+                                          % self.cycle_detection())
+            # The next rounds only depend on the current actions
+            # with deterministic rules
+            if self.config['simulation_type'] != 'assign2' \
+                    or not self.is_update_mechanism('unconditional_imitation'):
+                raise SimulationException("cycle_detection is only "
+                                          "supported by 'assign2' with "
+                                          "'unconditional_imitation'")
+
+    def check_resume(self):
+        if self.config.get('resume', False) and self.config.get('gif', False):
+            raise SimulationException("A GIF export cannot be resumed")
+
     def run(self):
         try:
             runs = {
@@ -541,10 +3000,164 @@ class Simulation:
             if self.config['simulation_type'] not in runs:
                 raise SimulationException("Unknown simulation type %s" %
                                           self.config['simulation_type'])
-            runs[self.config['simulation_type']]()
+            self.check_engine()
+            self.check_resume()
+            self.cycle_detector = self.init_cycle_detector()
+            first_round = 0
+            if self.config.get('resume', False):
+                first_round = self.resume_checkpoint()
+            if self.plots():
+                self.renderer = SnapshotRenderer(self.config)
+            self.recorder = self.init_recorder(first_round)
+            self.gif = self.init_gif()
+            self.init_checkpoints()
+            runs[self.config['simulation_type']](first_round)
+            if self.checkpointing():
+                self.write_checkpoint()
+            if self.renderer is not None:
+                self.renderer.close()
+            if self.instrumentation is not None:
+                self.instrumentation.write(self.results_instrumentation())
+                log.info("Instrumentation summary written in '%s'"
+                         % self.results_instrumentation())
         except KeyboardInterrupt:
             log.error("Simulation interupted.")
+            if self.renderer is not None:
+                self.renderer.close(terminate=True)
             exit(130)
+        except Exception:
+            if self.renderer is not None:
+                self.renderer.close(terminate=True)
+            raise
+        finally:
+            if self.sigint_handler is not None:
+                signal.signal(signal.SIGINT, self.sigint_handler)
+                self.sigint_handler = None
+            if self.recorder is not None:
+                self.recorder.close()
+            if self.gif is not None:
+                self.gif.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+# Above this fraction of changed cells, incremental rounds are full rounds
+Simulation.INCREMENTAL_MAX_DIRTY = 0.1
+# Action played when deliberating, by game name
+Simulation.DELIBERATE_ACTIONS = {
+    'coordination game': ACTIONS['C']['value'],
+    'prisoners dilemma': ACTIONS['D']['value']
+}
+
+
+class BatchSimulation(Simulation):
+    """Replicates of an 'assign2' simulation played together: their
+    lattices are stacked in (replicates, size, size) arrays, advanced
+    each round by the vectorized rules.
+
+    Each replicate draws from its own generator, seeded as the single
+    simulation, so that it plays the same rounds. Only the data is
+    gathered, as (replicates, nround) arrays, nothing is plotted nor
+    recorded.
+    """
+
+    def __init__(self, config, seeds):
+        self.replicates = len(seeds)
+        super().__init__(config, seed=seeds[0])
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+
+    def init_data(self):
+        return {key: np.zeros((self.replicates, self.nround()))
+                for key in ('coop_levels', 'int_coop_levels', 'threshold')}
+
+    def init_lattices(self):
+        lattices = Lattice(self.size, ACTION_DTYPE,
+                           replicates=self.replicates), \
+                   Lattice(self.size, self.float_dtype(),
+                           replicates=self.replicates), \
+                   Lattice(self.size, self.float_dtype(),
+                           replicates=self.replicates), \
+                   Lattice(self.size, ACTION_DTYPE,
+                           replicates=self.replicates)
+        for lattice in lattices:
+            lattice.add_matrix()
+            lattice.add_matrix()
+        return lattices
+
+    def generate_results_dir(self):
+        self._results_dir = self.config['results_dir']
+
+    def engine(self):
+        return 'vectorized'
+
+    def draw(self, method, *args):
+        """Return the numbers drawn by the method of each replicate
+        generator, stacked."""
+        return np.stack([getattr(rng, method)(*args) for rng in self.rngs])
+
+    def replicate_data(self, replicate):
+        """Return the data of a replicate, as Simulation.data()."""
+        data = {key: values[replicate].tolist()
+                for key, values in self._data.items()}
+        data.update(cycle_period=None, cycle_round=None)
+        return data
+
+    def coop_percentages(self, lattice):
+        """Return the cooperation level of each replicate, rounded as
+        Simulation.current_coop_percentage."""
+        ncoop = np.count_nonzero(Simulation.flat(lattice.current())
+                                 == ACTIONS['C']['value'], axis=-1)
+        return [round((int(n) / self.npeople()) * 100, 2) for n in ncoop]
+
+    def gather_current_data(self):
+        self._data['coop_levels'][:, self.t] = \
+            self.coop_percentages(self.rounds)
+        self._data['int_coop_levels'][:, self.t] = \
+            self.coop_percentages(self.intuitive_actions)
+        total = np.sum(Simulation.flat(self.thresholds.current()), axis=-1,
+                       dtype=np.float64)
+        self._data['threshold'][:, self.t] = total / self.npeople()
+
+    def check_engine(self):
+        if self.config['simulation_type'] != 'assign2':
+            raise SimulationException("Batches only support "
+                                      "simulation_type assign2")
+        if self.incremental() or self.cycle_detection() is not None \
+                or self.checkpointing() or self.config.get('resume', False):
+            raise SimulationException("Batches do not support incremental, "
+                                      "cycle_detection nor checkpoints")
+        super().check_engine()
+
+    def run(self):
+        self.check_engine()
+        log.info("Starting a batch of %d 'assign2' simulations"
+                 % self.replicates)
+        self.payoff = self.build_payoff()
+        for t in range(self.nround()):
+            self.t = t
+            self.call_hooks('on_round_start')
+            self.start_round(t)
+            self.play_and_score_round()
+            self.gather_current_data()
+            self.call_hooks('on_round_end')
+
+
+def run_simulation(config, simuid, seed):
+    """Run a single simulation and return its data.
+    Used as the entry point of the MultipleSimulation worker processes."""
+    simu = Simulation(config, simuid, seed)
+    simu.run()
+    return simu.data()
+
+
+def run_batch(config, seeds):
+    """Run a batch of simulations and return the data of each one.
+    Used as the entry point of the MultipleSimulation worker processes."""
+    batch = BatchSimulation(config, seeds)
+    batch.run()
+    return [batch.replicate_data(replicate)
+            for replicate in range(len(seeds))]
 
 
 class MultipleSimulation:
@@ -552,13 +3165,30 @@ class MultipleSimulation:
     def __init__(self, config):
         self.config = config
         self.nsimul = self.config['number_of_simulations']
-        self.all_data = []
+        self.workers = self.config.get('workers', 1)
+        self.batch_size = self.config.get('batch_size', 0)
+        self.master_seed = self.init_master_seed()
+        self.stats = self.init_stats()
+        self.nsucceeded = 0
+        self.failed = {}
         self.generate_number_of_round()
 
+    def init_master_seed(self):
+        """Return the master seed of the resumed run, config.seed, or a
+        random seed."""
+        if self.config.get('resume', False) \
+                and os.path.exists(self.results_run()):
+            with open(self.results_run()) as f:
+                return json.load(f)['master_seed']
+        if self.config.get('seed') is not None:
+            return self.config['seed']
+        return np.random.SeedSequence().entropy
+
     def generate_number_of_round(self):
-        self.config['number_of_round'] = random.randint(
+        rng = np.random.default_rng(self.master_seed)
+        self.config['number_of_round'] = int(rng.integers(
             self.config['last_round'][0],
-            self.config['last_round'][1])
+            self.config['last_round'][1], endpoint=True))
 
     def results_dir(self):
         return self.config['results_dir']
@@ -566,7 +3196,20 @@ class MultipleSimulation:
     def results_coop_fig(self):
         return os.path.join(self.results_dir(), 'average_coop')
 
+    def results_run(self):
+        return os.path.join(self.results_dir(), 'run.json')
+
+    def results_summary(self):
+        return os.path.join(self.results_dir(), 'summary.json')
+
     def create_results_dir(self):
+        """Create the results directory, and write the master seed in it
+        for the run to be resumed. When resuming, an existing directory
+        is kept as is."""
+        if self.config.get('resume', False) \
+                and os.path.exists(self.results_dir()):
+            log.info("Resuming the run of '%s'" % self.results_dir())
+            return
         if os.path.exists(self.results_dir()):
             if self.config['results_dir_rm']:
                 log.warning("Removing existing directory '%s'"
@@ -577,40 +3220,211 @@ class MultipleSimulation:
                           "' already exists.")
                 exit(1)
         EvoDynUtils.mkdir(self.results_dir())
+        with open(self.results_run(), 'w') as f:
+            json.dump({'master_seed': int(self.master_seed)}, f)
 
-    def plot_average_coop_levels(self):
-        nround = self.config['number_of_round']
-        average_coop_levels = [0 for r in range(nround)]
-        for s in range(self.nsimul):
-            for r in range(nround):
-                average_coop_levels[r] += self.all_data[s]['coop_levels'][r]
-        for r in range(nround):
-            average_coop_levels[r] = average_coop_levels[r] / self.nsimul
-        message = "Plot average cooperation levels for %s simulations" \
-                  % (self.nsimul)
-        xlabel, ylabel = "Rounds", "Average coop. level for %s simulations" \
-                         % (self.nsimul)
-        axis = [0, nround - 1, 0, 100]
-        EvoDynUtils.plot(self.results_coop_fig(), average_coop_levels,
-                         axis, xlabel, ylabel, message)
+    def results_int_coop_fig(self):
+        return os.path.join(self.results_dir(), 'average_int_coop')
+
+    def results_threshold_fig(self):
+        return os.path.join(self.results_dir(), 'average_threshold')
+
+    def init_stats(self):
+        """Return the RunningStats of each averaged data series."""
+        bins = self.config.get('quantile_bins', 0)
+        return {
+            'coop_levels': RunningStats((0, 100), bins),
+            'int_coop_levels': RunningStats((0, 100), bins),
+            'threshold': RunningStats(tuple(self.config['threshold_dist']),
+                                      bins)
+        }
+
+    def update_stats(self, data):
+        for key, stats in self.stats.items():
+            stats.update(data[key])
+        self.nsucceeded += 1
+
+    def plot_average(self, key, fig, ylabel, ymax):
+        stats = self.stats[key]
+        message = "Plot average %s for %s simulations" \
+                  % (key, self.nsucceeded)
+        xlabel = "Rounds"
+        ylabel = "Average %s for %s simulations" % (ylabel, self.nsucceeded)
+        axis = [0, max(len(stats) - 1, 1), 0, ymax]
+        quantiles = None
+        if stats.bins > 0:
+            quantiles = tuple(self.config.get('quantiles', (0.1, 0.9)))
+        EvoDynUtils.plot_bands(fig, stats, axis, xlabel, ylabel, message,
+                               quantiles)
+
+    def plot_averages(self):
+        self.plot_average('coop_levels', self.results_coop_fig(),
+                          'coop. level', 100)
+        if self.config['simulation_type'] == 'gamma':
+            self.plot_average('int_coop_levels', self.results_int_coop_fig(),
+                              'int. coop. level', 100)
+            self.plot_average('threshold', self.results_threshold_fig(),
+                              'threshold', self.config['threshold_dist'][1])
+
+    def simulation_seed(self, simuid):
+        return EvoDynUtils.simulation_seed(self.master_seed, simuid)
+
+    def _collect(self, simuid, get_data):
+        """Add the data returned by get_data to the averages, or record
+        the simulation as failed if it raises."""
+        try:
+            data = get_data()
+        except Exception as e:
+            log.error("Simulation #%d failed: %r" % (simuid, e))
+            self.failed[simuid] = repr(e)
+            return
+        self.update_stats(data)
 
     def _run_simu(self, simuid):
         print()
         log.info('Running simluation #%d' % simuid)
-        simu = Simulation(self.config, simuid)
-        simu.run()
-        self.all_data.append(simu.data())
+        self._collect(simuid, lambda: run_simulation(
+            self.config, simuid, self.simulation_seed(simuid)))
+
+    def _run_isolated(self, simuid):
+        """Run a simulation alone in a new worker process and return its
+        data, so that a crash of the process is blamed on it only.
+        The results directory left by the first run, if any, is removed
+        (unless resuming, where it is reused)."""
+        directory = os.path.join(self.results_dir(), 'simu_%d' % simuid)
+        if not self.config.get('resume', False) and os.path.isdir(directory):
+            shutil.rmtree(directory)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            return executor.submit(run_simulation, self.config, simuid,
+                                   self.simulation_seed(simuid)).result()
+
+    def _run_simus_in_pool(self):
+        """Run the simulations in a pool of self.workers processes.
+        At most 2 * workers simulations are submitted at once, and
+        the results are collected in simuid order, so that the results
+        do not depend on the number of workers.
+
+        A simulation killing its worker process (segfault, out of memory)
+        breaks the pool: the pool is recreated for the next simulations,
+        and the ones that were pending are rerun one at a time, so that
+        only the simulation that crashed is recorded as failed."""
+        simuids = iter(range(self.nsimul))
+        pending = collections.deque()
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        def submit(simuid):
+            nonlocal executor
+            log.info('Submitting simluation #%d' % simuid)
+            seed = self.simulation_seed(simuid)
+            try:
+                future = executor.submit(run_simulation, self.config,
+                                         simuid, seed)
+            except BrokenProcessPool:
+                log.warning("A worker process died, restarting the pool")
+                executor.shutdown()
+                executor = ProcessPoolExecutor(max_workers=self.workers)
+                future = executor.submit(run_simulation, self.config,
+                                         simuid, seed)
+            pending.append((simuid, future))
+        try:
+            for simuid in simuids:
+                submit(simuid)
+                if len(pending) == 2 * self.workers:
+                    break
+            while pending:
+                simuid, future = pending.popleft()
+                if isinstance(future.exception(), BrokenProcessPool):
+                    log.warning("Rerunning simulation #%d alone" % simuid)
+                    self._collect(simuid, lambda: self._run_isolated(simuid))
+                else:
+                    self._collect(simuid, future.result)
+                simuid = next(simuids, None)
+                if simuid is not None:
+                    submit(simuid)
+        finally:
+            executor.shutdown()
+
+    def batches(self):
+        """Return the simuids of each batch of batch_size simulations."""
+        return [range(start, min(start + self.batch_size, self.nsimul))
+                for start in range(0, self.nsimul, self.batch_size)]
+
+    def _collect_batch(self, simuids, get_data):
+        """Add the data of the simulations of a batch to the averages,
+        or record them all as failed if the batch raises."""
+        try:
+            data = get_data()
+        except Exception as e:
+            log.error("Batch of simulations #%d-%d failed: %r"
+                      % (simuids[0], simuids[-1], e))
+            for simuid in simuids:
+                self.failed[simuid] = repr(e)
+            return
+        for replicate_data in data:
+            self.update_stats(replicate_data)
+
+    def _run_batches(self):
+        """Run the simulations in batches of batch_size replicates, in
+        a pool of self.workers processes if workers > 1. The results are
+        collected in simuid order."""
+        seeds = [[self.simulation_seed(simuid) for simuid in simuids]
+                 for simuids in self.batches()]
+        if self.workers <= 1:
+            for simuids, batch_seeds in zip(self.batches(), seeds):
+                log.info('Running simulations #%d-%d in a batch'
+                         % (simuids[0], simuids[-1]))
+                self._collect_batch(simuids, lambda: run_batch(
+                    self.config, batch_seeds))
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(run_batch, self.config, batch_seeds)
+                       for batch_seeds in seeds]
+            for simuids, future in zip(self.batches(), futures):
+                self._collect_batch(simuids, future.result)
+
+    def summary(self):
+        """Return the averaged results, as JSON serializable values."""
+        return {
+            'number_of_round': self.config['number_of_round'],
+            'master_seed': int(self.master_seed),
+            'nsucceeded': self.nsucceeded,
+            'failed': {str(simuid): error
+                       for simuid, error in self.failed.items()},
+            'stats': {key: stats.summary()
+                      for key, stats in self.stats.items()}
+        }
+
+    def write_summary(self):
+        log.info("Averaged results written in '%s'" % self.results_summary())
+        with open(self.results_summary(), 'w') as f:
+            json.dump(self.summary(), f, indent=1)
 
     def run(self):
         self.create_results_dir()
         start_time = time.time()
-        for simuid in range(self.nsimul):
-            self._run_simu(simuid)
-        self.plot_average_coop_levels()
+        log.info("Master seed: %d" % self.master_seed)
+        if self.batch_size > 0:
+            self._run_batches()
+        elif self.workers > 1:
+            self._run_simus_in_pool()
+        else:
+            for simuid in range(self.nsimul):
+                self._run_simu(simuid)
+        if self.failed:
+            log.error("%d simulations failed: %s"
+                      % (len(self.failed), sorted(self.failed)))
+        if self.nsucceeded == 0:
+            raise SimulationException("No simulation succeeded, "
+                                      "nothing to average")
+        if self.config.get('plots', True):
+            self.plot_averages()
+        else:
+            self.write_summary()
         print()
         log.info("%d simulations in %d seconds"
                  % (self.nsimul, time.time() - start_time))
 
 
 if __name__ == "__main__":
+    EvoDynUtils.init_logging()
     MultipleSimulation(EvoDynUtils.get_config()).run()
@@ -43,6 +43,23 @@ snowdrift_game = {
 simulation_type = "gamma"
 
 number_of_simulations = 1
+# Number of processes running the simulations in parallel
+workers = 1
+# If > 0, the simulations are played in batches of batch_size replicates
+# stacked in 3-D arrays ('assign2' only, with the 'vectorized' rules and
+# the same results). Faster for small sizes, but nothing is plotted nor
+# recorded for the individual simulations.
+batch_size = 0
+# If > 0, the averaged plots also show the band between the quantiles
+# below, estimated with a histogram of quantile_bins bins for each round
+quantile_bins = 0
+quantiles = (0.1, 0.9)
+# Master seed: every random number of a run (number of rounds,
+# start actions, thresholds, games, costs...) is drawn from generators
+# seeded from it, the seed of each simulation being derived from it and
+# from the simulation id. The same seed reproduces the same run.
+# If None, a random master seed is used (logged).
+seed = None
 
 ### Game configuration ###
 
@@ -59,11 +76,76 @@ start_method = 'probability'
 start_coop_probability = 0.5  # q
 # Accepted values: 'moore', 'von_neumann'
 neighbor_type = 'moore'
-# Accepted values: 'unconditional_imitation', 'replicator_rule'
+# Neighbors up to neighbor_radius cells away (1 for the usual neighborhoods)
+neighbor_radius = 1
+# If True the lattice is a torus, otherwise the cells on the
+# borders have less neighbors
+periodic = True
+# Interaction graph instead of the lattice neighborhoods (the cells are
+# still shown as a size x size lattice). Accepted values: None (lattice),
+# 'file' (edge list in graph_file, one 'cell cell' pair per line, cells
+# numbered from 0 to size * size - 1), 'random_regular', 'small_world'
+# (Watts-Strogatz) or 'scale_free' (Barabasi-Albert)
+graph = None
+graph_file = 'graph.txt'
+# Number of neighbors of the generated graphs (average for 'scale_free')
+graph_degree = 4
+# 'small_world' probability to rewire an edge
+graph_rewiring = 0.1
+# Seed of the generated graphs, the same for all the simulations
+graph_seed = 0
+# Accepted values: 'unconditional_imitation', 'replicator_rule',
+# 'fermi_rule'
 update_mechanism = 'unconditional_imitation'
+# 'fermi_rule' temperature K: a neighbor scoring d more is imitated with
+# probability 1 / (1 + exp(-d / K))
+fermi_temperature = 0.1
+# dtype of the score and threshold lattices: 'float64' or 'float32'
+# (actions are always stored as uint8)
+float_dtype = 'float64'
+# Accepted values: 'loop' (per-cell rules), 'vectorized' (whole lattice
+# numpy rules, 'assign2' only), 'compiled' (numba kernel if installed,
+# 'gamma' only), 'bitpacked'
+# (actions packed 64 cells per word, for very large lattices, 'assign2'
+# with 'unconditional_imitation' and integer payoffs on periodic lattices
+# only), 'tiled'
+# (lattices larger than the memory, stored in results_dir/simu_*/tiles
+# and played one tile at a time, 'assign2' with 'unconditional_imitation'
+# only, without checkpoints nor cycle_detection; the plotted, recorded
+# and exported rounds are still read whole), 'threaded' (the lattice is
+# split in row stripes updated by threads, 'assign2' with
+# 'unconditional_imitation' only)
+engine = 'loop'
+# With 'threaded', number of threads of each simulation, 0 for the number
+# of CPUs (mind the workers processes, which each have their threads)
+threads = 0
+# With 'tiled', side in cells of the tiles: the memory used is a few
+# (tile_size + 2 * neighbor_radius) ** 2 arrays
+tile_size = 1024
+# With the 'vectorized' engine and 'unconditional_imitation', only update
+# the cells whose neighborhood changed in the previous round
+incremental = False
+# Check every incremental round against a full recomputation (slow)
+incremental_check = False
+# With 'assign2' and 'unconditional_imitation', detect when the lattice
+# reaches a fixed point or a cycle. Accepted values: None (no detection),
+# 'stop' (stop the simulation) or 'fast_forward' (stop the simulation
+# and fill the data of the remaining rounds from the cycle)
+cycle_detection = None
+# Number of past rounds a round is compared to (longest detected period)
+cycle_window = 8
+
+# If True, time the rounds and their phases, count the calls of the
+# per-cell methods ('loop' engine) and track the lattices memory, in
+# results_dir/simu_*/instrumentation.json
+instrument = False
 
 ### Matrix plot configuration ###
 
+# If False, run headless: no figure nor matrix plot is rendered (matplotlib
+# is not even imported). Only summary.json, the averaged results, is written
+# along with the trajectories, gif and checkpoints if enabled
+plots = True
 # If False, show only time_visualize steps
 # Note that more you plot, more it takes time!
 time_visualize_all = False
@@ -71,6 +153,52 @@ time_visualize_all = False
 time_visualize = (1, 5, 10, 20, 50)
 show_color_bar = False
 show_axis = True
+# Number of processes rendering the plotted rounds in the background.
+# If 0, rounds are rendered by the simulation itself.
+render_workers = 0
+# Maximum number of rounds waiting to be rendered, the simulation
+# waits for the renderers when it is reached
+render_queue_size = 16
+# 'matplotlib', or 'png' to write the matrix straight to a PNG
+# (faster, but without axis nor color bar)
+render_backend = 'matplotlib'
+# With 'png', size in pixels of a cell
+render_scale = 4
+
+### Checkpoints ###
+
+# Write the state of each simulation in results_dir/simu_*/checkpoint.npz
+# every checkpoint_rounds rounds and/or every checkpoint_seconds seconds
+# (0 to disable), at the end of the simulation, and on Ctrl-C once the
+# current round is played
+checkpoint_rounds = 0
+checkpoint_seconds = 0
+# If True, the existing results_dir is kept and each simulation continues
+# from its checkpoint, with the same results as an uninterrupted run
+resume = False
+
+### Trajectory recording ###
+
+# If True, the lattices of every round (actions, and intuitive actions
+# and thresholds for 'gamma') are recorded in results_dir/simu_*/trajectory
+# and can be read back with evodyn.TrajectoryReader
+record = False
+# Rounds written at once (and per file if compressed)
+record_chunk_rounds = 64
+# If True, chunks are zlib compressed (.npz) instead of memory mapped (.npy)
+record_compress = False
+
+# If True, the rounds are exported as an animated GIF
+# (results_dir/simu_*/rounds.gif) while the simulation runs
+gif = False
+# Export one round every gif_stride rounds
+gif_stride = 1
+# Keep one cell every gif_downscale cells in each direction
+gif_downscale = 1
+# Size in pixels of a cell
+gif_scale = 1
+# Time between frames, in hundredths of second
+gif_delay = 10
 
 ### EvoDyn configuration ###
 
@@ -0,0 +1,165 @@
+#!/bin/python3
+"""Run a parameter sweep: one MultipleSimulation per combination of
+config overrides, cached on disk by the hash of the resolved config.
+
+    python3 sweep.py sweep.json
+
+with sweep.json such as:
+
+    {
+        "config": "sample.py",
+        "grid": {"gamma_p": [0.1, 0.5, 0.9], "size": [50, 100]},
+        "points": [{"b": 2, "c": 1}, {"b": 3, "c": 1}],
+        "seed": 0,
+        "cache_dir": "sweep_cache",
+        "workers": 4
+    }
+
+Every point of "points" is combined with every combination of "grid".
+Points whose result is already in cache_dir are skipped, so that an
+interrupted sweep resumes where it stopped when launched again.
+"""
+
+import sys
+import os
+import json
+import time
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from evodyn import EvoDynUtils, MultipleSimulation, log
+
+# Config keys only changing the outputs, not the results
+OUTPUT_KEYS = ('results_dir', 'results_dir_rm', 'workers', 'plots',
+               'time_visualize_all', 'time_visualize', 'show_color_bar',
+               'show_axis', 'render_workers', 'render_queue_size',
+               'render_backend', 'render_scale', 'record',
+               'record_chunk_rounds', 'record_compress', 'gif', 'gif_stride',
+               'gif_downscale', 'gif_scale', 'gif_delay', 'checkpoint_rounds',
+               'checkpoint_seconds', 'resume', 'instrument', 'threads',
+               'tile_size')
+
+
+def expand(grid=None, points=None):
+    """Return the list of overrides: every point combined with every
+    combination of the grid values."""
+    grid = grid or {}
+    names = sorted(grid)
+    combinations = [dict(zip(names, values)) for values
+                    in itertools.product(*(grid[name] for name in names))]
+    return [dict(point, **combination)
+            for point in (points or [{}]) for combination in combinations]
+
+
+def config_hash(config):
+    """Return the hash of the config values changing the results."""
+    values = {key: value for key, value in config.items()
+              if key not in OUTPUT_KEYS}
+    canonical = json.dumps(values, sort_keys=True, default=repr)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def write_json(path, value):
+    """Write value in path atomically: readers either see the previous
+    file or the complete new one."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=1, default=repr)
+    os.replace(tmp, path)
+
+
+def run_point(config, directory):
+    """Run the MultipleSimulation of a sweep point in directory and
+    store its summary in directory/result.json."""
+    config = dict(config, results_dir=os.path.join(directory, 'results'),
+                  results_dir_rm=True)
+    multiple = MultipleSimulation(config)
+    multiple.run()
+    write_json(os.path.join(directory, Sweep.RESULT), multiple.summary())
+    return multiple.summary()
+
+
+class Sweep:
+
+    RESULT = 'result.json'
+
+    def __init__(self, spec):
+        self.config_path = spec.get('config', 'sample.py')
+        self.cache_dir = spec.get('cache_dir', 'sweep_cache')
+        self.workers = spec.get('workers', 1)
+        self.seed = spec.get('seed', 0)
+        self.overrides = expand(spec.get('grid'), spec.get('points'))
+
+    def resolve(self, overrides):
+        """Return the config of a point. Without seed in the config,
+        the sweep seed is used, so that points can be cached."""
+        config = EvoDynUtils.get_config(self.config_path, overrides)
+        if config.get('seed') is None:
+            config['seed'] = self.seed
+        return config
+
+    def point_dir(self, config):
+        return os.path.join(self.cache_dir, config_hash(config))
+
+    def is_done(self, directory):
+        return os.path.exists(os.path.join(directory, Sweep.RESULT))
+
+    def run(self):
+        """Run the points missing from the cache and return the list
+        of (overrides, hash, summary) of every point."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        points, todo = [], []
+        for overrides in self.overrides:
+            config = self.resolve(overrides)
+            directory = self.point_dir(config)
+            points.append((overrides, directory))
+            if self.is_done(directory):
+                log.info("Cached: %s (%s)" % (overrides, directory))
+            elif directory not in [d for _, d in todo]:
+                os.makedirs(directory, exist_ok=True)
+                write_json(os.path.join(directory, 'config.json'), config)
+                todo.append((config, directory))
+        log.info("%d points, %d to run" % (len(points), len(todo)))
+        start_time = time.time()
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(run_point, config, directory):
+                           directory for config, directory in todo}
+                for future in as_completed(futures):
+                    self.report(futures[future], future.exception())
+        else:
+            for config, directory in todo:
+                try:
+                    run_point(config, directory)
+                    self.report(directory, None)
+                except Exception as e:
+                    self.report(directory, e)
+        log.info("%d points in %d seconds"
+                 % (len(todo), time.time() - start_time))
+        results = []
+        for overrides, directory in points:
+            summary = None
+            if self.is_done(directory):
+                with open(os.path.join(directory, Sweep.RESULT)) as f:
+                    summary = json.load(f)
+            results.append((overrides, os.path.basename(directory), summary))
+        write_json(os.path.join(self.cache_dir, 'sweep.json'),
+                   [{'overrides': overrides, 'hash': point_hash}
+                    for overrides, point_hash, _ in results])
+        return results
+
+    def report(self, directory, error):
+        if error is None:
+            log.info("Done: %s" % directory)
+        else:
+            log.error("Point %s failed: %r" % (directory, error))
+
+
+if __name__ == "__main__":
+    EvoDynUtils.init_logging()
+    if len(sys.argv) != 2:
+        print("Usage: %s sweep.json" % sys.argv[0])
+        exit(1)
+    with open(sys.argv[1]) as f:
+        Sweep(json.load(f)).run()
@@ -1,6 +1,84 @@
 import unittest
+import unittest.mock
+import tempfile
+import signal
+import subprocess
+import sys
+import evodyn
+import sweep
+import benchmark
 from evodyn import *
 
+
+# Root of the temporary directories of the tests, removed after them
+TEMPORARY_ROOT = tempfile.TemporaryDirectory()
+
+
+def tearDownModule():
+    TEMPORARY_ROOT.cleanup()
+
+
+def temporary_dir():
+    return tempfile.mkdtemp(dir=TEMPORARY_ROOT.name)
+
+
+def make_config(**overrides):
+    """Return the sample.py config with a temporary results_dir, small
+    sizes and no plotted rounds, updated with overrides."""
+    config = EvoDynUtils.get_config()
+    config.update({
+        'results_dir': temporary_dir(),
+        'size': 12,
+        'number_of_round': 10,
+        'time_visualize_all': False,
+        'time_visualize': ()
+    })
+    config.update(overrides)
+    return config
+
+
+def run_simulation(seed, **overrides):
+    simu = Simulation(make_config(seed=seed, **overrides))
+    simu.run()
+    return simu
+
+
+def unpacked_scores(simu):
+    return simu.scores.unpack(simu.scores.current())
+
+
+def assert_same_as_vectorized(test, engine, scores_of, **overrides):
+    """Check that an assign2 simulation run with engine has the same data,
+    actions and scores (read with scores_of(simu)) as with 'vectorized'."""
+    config = dict(simulation_type='assign2',
+                  game={'name': 'snowdrift', 'payoff': (10, 7, 0, 3)})
+    config.update(overrides)
+    vectorized = run_simulation(3, engine='vectorized', **config)
+    simu = run_simulation(3, engine=engine, **config)
+    test.assertEqual(vectorized.data(), simu.data())
+    test.assertTrue(np.array_equal(vectorized.rounds.current(),
+                                   simu.current_actions()))
+    test.assertTrue(np.array_equal(vectorized.scores.current(),
+                                   scores_of(simu)))
+
+
+def run_simulation_or_crash(config, simuid, seed):
+    """evodyn.run_simulation, killing its worker process for simuid 1."""
+    if simuid == 1:
+        os._exit(1)
+    return RUN_SIMULATION(config, simuid, seed)
+
+
+RUN_SIMULATION = evodyn.run_simulation
+
+
+def run_multiple(**overrides):
+    config = make_config(number_of_simulations=4, last_round=(6, 6),
+                         seed=42, **overrides)
+    multiple = MultipleSimulation(config)
+    multiple.run()
+    return multiple
+
 class TestNeighborMethods(unittest.TestCase):
 
     def test_up(self):
@@ -23,6 +101,40 @@ class TestNeighborMethods(unittest.TestCase):
         self.assertEqual(Neighbor.right(1, 3), 2)
         self.assertEqual(Neighbor.right(2, 3), 0)
 
+class TestTopology(unittest.TestCase):
+
+    def assertSameNeighbors(self, neighbor_type, neighbor_function):
+        size = 4
+        topology = Topology(size, neighbor_type)
+        for i in range(size):
+            for j in range(size):
+                expected = [ni * size + nj for ni, nj
+                            in neighbor_function(i, j, size, size)]
+                self.assertEqual(
+                    list(topology.cell_neighbors(topology.cell(i, j))),
+                    expected)
+
+    def test_moore(self):
+        self.assertSameNeighbors('moore', Neighbor.moore)
+
+    def test_von_neumann(self):
+        self.assertSameNeighbors('von_neumann', Neighbor.von_neumann)
+
+    def test_radius(self):
+        self.assertEqual(Topology(6, 'moore', 2).neighbors.shape, (36, 24))
+        self.assertEqual(Topology(6, 'von_neumann', 2).neighbors.shape,
+                         (36, 12))
+
+    def test_non_periodic(self):
+        topology = Topology(3, 'moore', periodic=False)
+        self.assertEqual(list(topology.degree), [3, 5, 3, 5, 8, 5, 3, 5, 3])
+        self.assertEqual(list(topology.cell_neighbors(0)), [1, 3, 4])
+        self.assertEqual(list(topology.neighbors[0]), [1, 3, 4] + [-1] * 5)
+
+    def test_unknown_neighbor_type(self):
+        self.assertRaises(SimulationException, Topology, 3, 'hexagonal')
+
+
 class TestLatticeMethods(unittest.TestCase):
 
     def test_add_matrix(self):
@@ -40,6 +152,933 @@ class TestLatticeMethods(unittest.TestCase):
         self.assertEqual(l.current_counts(1), 2)
         self.assertEqual(l.current_counts(2), 3)
 
+    def test_dtype(self):
+        l = Lattice(3, np.uint8)
+        m = l.add_matrix()
+        m[0, 0] = ACTIONS['D']['value']
+        self.assertEqual(m.dtype, np.uint8)
+        self.assertEqual(l.reset_current().dtype, np.uint8)
+        self.assertEqual(l.previous().dtype, np.uint8)
+        self.assertEqual(l.current_counts(ACTIONS['C']['value']), 9)
+
+    def test_reset_current_recycles_buffers(self):
+        l = Lattice(3)
+        first, second = l.add_matrix(), l.add_matrix()
+        second[1, 1] = 1
+        first[0, 0] = 1
+        for _ in range(5):
+            l.reset_current()
+        self.assertEqual(len(l.l), 2)
+        self.assertTrue(any(m is first for m in l.l))
+        self.assertTrue(any(m is second for m in l.l))
+        self.assertEqual(l.current_counts(0), 9)
+
+    def test_reset_current_keeps_previous(self):
+        l = Lattice(2)
+        l.add_matrix()
+        l.add_matrix()[0, 1] = 1
+        current = l.reset_current()
+        self.assertEqual(l.previous()[0, 1], 1)
+        self.assertEqual(np.count_nonzero(current), 0)
+
+
+class TestGraph(unittest.TestCase):
+
+    def test_from_edges(self):
+        graph = Graph.from_edges(2, [(0, 1), (1, 0), (2, 2), (3, 1)])
+        self.assertEqual(list(graph.indptr), [0, 1, 3, 3, 4])
+        self.assertEqual(list(graph.cell_neighbors(1)), [0, 3])
+        self.assertEqual(list(graph.degree), [1, 2, 0, 1])
+        self.assertEqual(list(graph.closed_neighborhood([0, 2])), [0, 1, 2])
+        self.assertRaises(SimulationException, Graph.from_edges, 2, [(0, 4)])
+
+    def test_load(self):
+        path = os.path.join(temporary_dir(), 'graph.txt')
+        with open(path, 'w') as f:
+            f.write('# cell cell\n0 3\n1 2\n')
+        simu = Simulation(make_config(size=2, graph='file', graph_file=path))
+        self.assertEqual(list(simu.topology.indices), [3, 2, 1, 0])
+
+    def test_generators(self):
+        for graph in ('random_regular', 'small_world', 'scale_free'):
+            topology = Simulation(make_config(graph=graph)).topology
+            cells = np.repeat(np.arange(topology.npeople()), topology.degree)
+            edges = set(zip(cells, topology.indices))
+            self.assertEqual(edges, {(b, a) for a, b in edges})
+            self.assertAlmostEqual(topology.degree.mean(), 4, delta=0.5)
+        self.assertRaises(SimulationException, Simulation,
+                          make_config(graph='lattice'))
+
+    def test_deliberation_cost_per_neighbor(self):
+        simu = run_simulation(1, simulation_type='gamma', graph='scale_free',
+                              cost_dist=[1, 1], threshold_dist=[1, 1])
+        expected = np.zeros(simu.npeople())
+        simu.calculate_score_graph(expected.reshape(simu.size, simu.size))
+        self.assertTrue(np.allclose(
+            simu.scores.current().reshape(-1),
+            expected - simu.cost * simu.topology.degree))
+
+
+class TestVectorizedEngine(unittest.TestCase):
+
+    def assertSameCoopLevels(self, **overrides):
+        loop = run_simulation(3, engine='loop', **overrides)
+        vectorized = run_simulation(3, engine='vectorized', **overrides)
+        self.assertEqual(loop.data('coop_levels'),
+                         vectorized.data('coop_levels'))
+        self.assertTrue(np.array_equal(loop.scores.current(),
+                                       vectorized.scores.current()))
+
+    def test_moore_probability(self):
+        self.assertSameCoopLevels(simulation_type='assign2',
+                                  neighbor_type='moore',
+                                  start_method='probability')
+
+    def test_von_neumann_middle_cluster(self):
+        self.assertSameCoopLevels(simulation_type='assign2',
+                                  neighbor_type='von_neumann',
+                                  start_method='middle_cluster')
+
+    def test_graphs(self):
+        for graph in ('random_regular', 'small_world', 'scale_free'):
+            self.assertSameCoopLevels(simulation_type='assign2', graph=graph)
+
+    def test_isolated_cells(self):
+        path = os.path.join(temporary_dir(), 'graph.txt')
+        with open(path, 'w') as f:
+            f.write('0 1\n1 2\n2 3\n')
+        for mechanism in ('unconditional_imitation', 'replicator_rule'):
+            self.assertSameCoopLevels(simulation_type='assign2', size=3,
+                                      graph='file', graph_file=path,
+                                      update_mechanism=mechanism)
+
+    def test_non_periodic_radius(self):
+        self.assertSameCoopLevels(simulation_type='assign2',
+                                  neighbor_type='moore',
+                                  neighbor_radius=2, periodic=False)
+
+    def test_stochastic_mechanisms(self):
+        for mechanism in ('replicator_rule', 'fermi_rule'):
+            self.assertSameCoopLevels(simulation_type='assign2',
+                                      update_mechanism=mechanism)
+            self.assertSameCoopLevels(simulation_type='assign2',
+                                      update_mechanism=mechanism,
+                                      float_dtype='float32',
+                                      neighbor_radius=2, periodic=False)
+            self.assertSameCoopLevels(simulation_type='assign2',
+                                      update_mechanism=mechanism,
+                                      graph='scale_free')
+
+    def test_fermi_temperature(self):
+        cold = run_simulation(3, simulation_type='assign2',
+                              update_mechanism='fermi_rule',
+                              fermi_temperature=1e-6)
+        imitation = run_simulation(3, simulation_type='assign2',
+                                   update_mechanism='fermi_rule',
+                                   fermi_temperature=1e6)
+        self.assertNotEqual(cold.data('coop_levels'),
+                            imitation.data('coop_levels'))
+        # Near zero temperature, a better neighbor is always imitated
+        self.assertEqual(cold.fermi_probability(np.float64(1), 4), 1)
+        self.assertEqual(cold.fermi_probability(np.float64(-1), 4), 0)
+        for temperature in (0, -1):
+            self.assertRaises(SimulationException, Simulation,
+                              make_config(simulation_type='assign2',
+                                          update_mechanism='fermi_rule',
+                                          fermi_temperature=temperature))
+
+
+class TestBitpackedEngine(unittest.TestCase):
+
+    def test_moore(self):
+        assert_same_as_vectorized(self, 'bitpacked',
+                                  Simulation.bitpacked_scores,
+                                  neighbor_type='moore')
+
+    def test_von_neumann_middle_cluster(self):
+        assert_same_as_vectorized(self, 'bitpacked',
+                                  Simulation.bitpacked_scores,
+                                  neighbor_type='von_neumann',
+                                  start_method='middle_cluster')
+
+    def test_padded_rows_radius(self):
+        assert_same_as_vectorized(self, 'bitpacked',
+                                  Simulation.bitpacked_scores, size=70,
+                                  neighbor_radius=2)
+
+    def test_start_played_a_few_rows_at_a_time(self):
+        with unittest.mock.patch.object(Simulation, 'START_CHUNK_CELLS', 30):
+            for start_method in ('probability', 'middle_cluster'):
+                assert_same_as_vectorized(self, 'bitpacked',
+                                          Simulation.bitpacked_scores,
+                                          start_method=start_method,
+                                          random_cluster=True)
+
+    def test_pack_shift(self):
+        lattice = BitLattice(70)
+        matrix = np.random.default_rng(0).integers(0, 2, (70, 70))
+        packed = lattice.pack(matrix)
+        self.assertTrue(np.array_equal(lattice.unpack(packed), matrix))
+        for dr, dc in ((1, 1), (-2, -65), (0, 69), (3, -1)):
+            self.assertTrue(np.array_equal(
+                lattice.unpack(lattice.shift(packed, dr, dc)),
+                np.roll(matrix, (-dr, -dc), axis=(0, 1))))
+        lattice.add_matrix()[...] = packed
+        self.assertEqual(lattice.current_counts(1), matrix.sum())
+
+    def test_unsupported(self):
+        for overrides in ({'update_mechanism': 'replicator_rule'},
+                          {'periodic': False}, {'graph': 'small_world'},
+                          {'game': {'name': 't',
+                                    'payoff': (1.1, 0.7, 0.1, 0.3)}}):
+            simu = Simulation(make_config(simulation_type='assign2',
+                                          engine='bitpacked', **overrides))
+            self.assertRaises(SimulationException, simu.run)
+
+
+class TestTiledEngine(unittest.TestCase):
+
+    def test_periodic(self):
+        assert_same_as_vectorized(self, 'tiled', unpacked_scores, tile_size=5)
+
+    def test_non_integer_payoff(self):
+        assert_same_as_vectorized(self, 'tiled', unpacked_scores, tile_size=7,
+                                  size=40, number_of_round=15,
+                                  game={'name': 't',
+                                        'payoff': (1.1, 0.7, 0.1, 0.3)})
+
+    def test_non_periodic_radius(self):
+        assert_same_as_vectorized(self, 'tiled', unpacked_scores, tile_size=5,
+                                  neighbor_type='von_neumann', periodic=False,
+                                  neighbor_radius=2)
+
+    def test_middle_cluster(self):
+        assert_same_as_vectorized(self, 'tiled', unpacked_scores, tile_size=4,
+                                  size=20, start_method='middle_cluster')
+
+    def test_tiled_matrix(self):
+        path = os.path.join(temporary_dir(), 'matrix.tiles')
+        matrix = TiledMatrix(path, 7, np.float32, 3)
+        values = np.arange(49, dtype=np.float32).reshape(7, 7)
+        for rows, cols in matrix.tiles():
+            matrix.write(rows, cols, values[rows.start:rows.stop,
+                                            cols.start:cols.stop])
+        self.assertEqual(os.path.getsize(path), 9 * 9 * 4)
+        self.assertTrue(np.array_equal(matrix.read([6, 0], [5, 6, 0]),
+                                       values[np.ix_([6, 0], [5, 6, 0])]))
+        matrix.clear()
+        self.assertEqual(np.count_nonzero(matrix.read(range(7), range(7))), 0)
+
+    def test_unsupported(self):
+        for overrides in ({'cycle_detection': 'stop'},
+                          {'checkpoint_rounds': 2}, {'graph': 'small_world'}):
+            simu = Simulation(make_config(simulation_type='assign2',
+                                          engine='tiled', **overrides))
+            self.assertRaises(SimulationException, simu.run)
+
+
+class TestThreadedEngine(unittest.TestCase):
+
+    def test_periodic(self):
+        assert_same_as_vectorized(self, 'threaded', unpacked_scores, threads=3)
+
+    def test_non_integer_payoff(self):
+        assert_same_as_vectorized(self, 'threaded', unpacked_scores, threads=3,
+                                  size=40, number_of_round=15,
+                                  game={'name': 't',
+                                        'payoff': (1.1, 0.7, 0.1, 0.3)})
+
+    def test_non_periodic_radius(self):
+        assert_same_as_vectorized(self, 'threaded', unpacked_scores, threads=5,
+                                  neighbor_type='von_neumann', periodic=False,
+                                  neighbor_radius=2)
+
+    def test_stripes(self):
+        simu = Simulation(make_config(size=10, engine='threaded', threads=4))
+        self.assertEqual([list(rows) for rows in simu.stripes()],
+                         [[0, 1], [2, 3, 4], [5, 6], [7, 8, 9]])
+        simu = Simulation(make_config(size=2, engine='threaded', threads=4))
+        self.assertEqual(len(simu.stripes()), 2)
+
+    def test_unsupported(self):
+        simu = Simulation(make_config(simulation_type='assign2',
+                                      engine='threaded', graph='small_world'))
+        self.assertRaises(SimulationException, simu.run)
+
+
+class TestIncrementalRounds(unittest.TestCase):
+
+    def setUp(self):
+        # Always use incremental rounds, even when most cells change
+        self.max_dirty = Simulation.INCREMENTAL_MAX_DIRTY
+        Simulation.INCREMENTAL_MAX_DIRTY = 1.0
+
+    def tearDown(self):
+        Simulation.INCREMENTAL_MAX_DIRTY = self.max_dirty
+
+    def assertSameAsFull(self, **overrides):
+        config = dict(simulation_type='assign2', engine='vectorized',
+                      size=20, number_of_round=30, **overrides)
+        full = run_simulation(4, **config)
+        incremental = run_simulation(4, incremental=True,
+                                     incremental_check=True, **config)
+        self.assertEqual(full.data(), incremental.data())
+
+    def test_games(self):
+        for payoff in ((10, 7, 0, 0), (10, 7, 5, 0), (1.2, 1, 0, 0.1)):
+            self.assertSameAsFull(game={'name': 'test', 'payoff': payoff})
+
+    def test_non_periodic(self):
+        self.assertSameAsFull(neighbor_type='von_neumann', periodic=False,
+                              neighbor_radius=2)
+
+    def test_frozen_lattice(self):
+        simu = run_simulation(1, simulation_type='assign2',
+                              engine='vectorized', incremental=True,
+                              number_of_round=30,
+                              game={'name': 'test', 'payoff': (10, 7, 5, 0)})
+        self.assertEqual(len(simu.dirty), 0)
+
+    def test_requires_vectorized_engine(self):
+        simu = Simulation(make_config(simulation_type='assign2',
+                                      incremental=True))
+        self.assertRaises(SimulationException, simu.run)
+
+
+class TestCompiledEngine(unittest.TestCase):
+
+    def assertSameData(self, **overrides):
+        loop = run_simulation(5, engine='loop', simulation_type='gamma',
+                              gamma_p=0.3, **overrides)
+        compiled_run = run_simulation(5, engine='compiled',
+                                      simulation_type='gamma',
+                                      gamma_p=0.3, **overrides)
+        self.assertEqual(loop.data(), compiled_run.data())
+        self.assertTrue(np.array_equal(loop.scores.current(),
+                                       compiled_run.scores.current()))
+
+    def test_moore(self):
+        self.assertSameData(neighbor_type='moore')
+
+    def test_von_neumann_non_periodic(self):
+        self.assertSameData(neighbor_type='von_neumann', periodic=False)
+
+    def test_graph(self):
+        self.assertSameData(graph='scale_free')
+
+    def test_isolated_cells(self):
+        path = os.path.join(temporary_dir(), 'graph.txt')
+        with open(path, 'w') as f:
+            f.write('0 1\n1 2\n2 3\n')
+        self.assertSameData(size=3, graph='file', graph_file=path)
+
+    def test_pure_python_kernel(self):
+        kernels = dict(evodyn._compiled_kernels)
+        evodyn._compiled_kernels[gamma_round_kernel] = gamma_round_kernel
+        try:
+            self.assertSameData(neighbor_type='moore', size=6)
+        finally:
+            evodyn._compiled_kernels.clear()
+            evodyn._compiled_kernels.update(kernels)
+
+    def test_unsupported_simulation_type(self):
+        simu = Simulation(make_config(simulation_type='assign2',
+                                      engine='compiled'))
+        self.assertRaises(SimulationException, simu.run)
+
+
+class TestRunningStats(unittest.TestCase):
+
+    def test_moments(self):
+        rng = np.random.default_rng(0)
+        series = [rng.uniform(0, 100, 5) for _ in range(10)] + \
+                 [rng.uniform(0, 100, 3)]
+        stats = RunningStats()
+        for values in series:
+            stats.update(values)
+        self.assertEqual(list(stats.count), [11, 11, 11, 10, 10])
+        first = np.array([values[0] for values in series])
+        self.assertAlmostEqual(stats.mean[0], first.mean())
+        self.assertAlmostEqual(stats.variance()[0], first.var(ddof=1))
+        self.assertEqual(stats.min[0], first.min())
+        self.assertEqual(stats.max[0], first.max())
+        low, high = stats.confidence_interval()
+        self.assertTrue((low <= stats.mean).all())
+        self.assertTrue((stats.mean <= high).all())
+
+    def test_quantiles(self):
+        stats = RunningStats((0, 100), bins=100)
+        for value in range(100):
+            stats.update([value + 0.5])
+        self.assertAlmostEqual(stats.quantile(0.1)[0], 10, delta=1)
+        self.assertAlmostEqual(stats.quantile(0.5)[0], 50, delta=1)
+        self.assertRaises(SimulationException, RunningStats().quantile, 0.5)
+
+
+class TestCycleDetection(unittest.TestCase):
+
+    def test_detector(self):
+        detector = CycleDetector(window=3)
+        states = [np.full((2, 2), v, dtype=np.uint8) for v in (0, 1, 2, 3, 2)]
+        for t, state in enumerate(states[:-1]):
+            self.assertIsNone(detector.update(t, state))
+        self.assertEqual(detector.update(4, states[-1]), (2, 2))
+        # State of t0 is out of the window
+        self.assertIsNone(detector.update(5, states[0]))
+
+    def test_fast_forward(self):
+        for engine in ('loop', 'vectorized'):
+            config = dict(simulation_type='assign2', engine=engine,
+                          number_of_round=40,
+                          game={'name': 'test', 'payoff': (10, 7, 5, 0)})
+            full = run_simulation(2, **config)
+            fast = run_simulation(2, cycle_detection='fast_forward', **config)
+            self.assertIsNotNone(fast.data('cycle_period'))
+            self.assertLess(fast.t, 39)
+            for key in ('coop_levels', 'int_coop_levels', 'threshold'):
+                self.assertEqual(full.data(key), fast.data(key))
+
+    def test_stop(self):
+        simu = run_simulation(2, simulation_type='assign2',
+                              number_of_round=40,
+                              cycle_detection='stop',
+                              game={'name': 'test', 'payoff': (10, 7, 5, 0)})
+        self.assertEqual(len(simu.data('coop_levels')), simu.t + 1)
+        self.assertEqual(simu.data('cycle_round') + simu.data('cycle_period'),
+                         simu.t)
+
+    def test_requires_deterministic_rules(self):
+        simu = Simulation(make_config(simulation_type='gamma',
+                                      cycle_detection='stop'))
+        self.assertRaises(SimulationException, simu.run)
+
+
+class TestLatticeDtypes(unittest.TestCase):
+
+    def test_simulation_dtypes(self):
+        simu = run_simulation(1, float_dtype='float32', time_visualize=(1,))
+        self.assertEqual(simu.rounds.current().dtype, ACTION_DTYPE)
+        self.assertEqual(simu.intuitive_actions.current().dtype, ACTION_DTYPE)
+        self.assertEqual(simu.scores.current().dtype, np.float32)
+        self.assertEqual(simu.thresholds.current().dtype, np.float32)
+        self.assertTrue(os.path.exists(
+            os.path.join(simu.results_dir(), 't1.png')))
+
+    def test_invalid_float_dtype(self):
+        self.assertRaises(SimulationException, Simulation,
+                          make_config(float_dtype='int32'))
+
+
+class TestRandomDraws(unittest.TestCase):
+
+    def test_same_seed_same_data(self):
+        for simulation_type in ('gamma', 'assign2'):
+            first = run_simulation(7, simulation_type=simulation_type,
+                                   update_mechanism='replicator_rule')
+            second = run_simulation(7, simulation_type=simulation_type,
+                                    update_mechanism='replicator_rule')
+            self.assertEqual(first.data(), second.data())
+
+    def test_different_seeds(self):
+        self.assertNotEqual(run_simulation(1).data(), run_simulation(2).data())
+
+    def test_draws_one_value_per_cell(self):
+        simu = Simulation(make_config(simulation_type='assign2',
+                                      update_mechanism='replicator_rule',
+                                      periodic=False))
+        simu.draw_round()
+        self.assertEqual(simu.draws['start'].shape, (simu.npeople(),))
+        simu.t = 1
+        simu.draw_round()
+        self.assertEqual(sorted(simu.draws), ['accept', 'neighbor'])
+        self.assertTrue((simu.draws['neighbor'] < simu.topology.degree).all())
+
+
+class TestSnapshotRenderer(unittest.TestCase):
+
+    def test_write_png(self):
+        import matplotlib.image
+        path = os.path.join(temporary_dir(), 'm.png')
+        matrix = np.array([[0, 1, 1], [1, 0, 0]])
+        EvoDynUtils.write_png(path, matrix, EvoDynUtils.actions_palette(), 2)
+        image = matplotlib.image.imread(path)
+        self.assertEqual(image.shape[:2], (4, 6))
+        self.assertEqual(tuple(image[0, 0, :3]), (0, 0, 1))
+        self.assertEqual(tuple(image[3, 5, :3]), (0, 0, 1))
+        self.assertEqual(tuple(image[0, 2, :3]), (1, 0, 0))
+
+    def test_background_renderers(self):
+        for backend in ('png', 'matplotlib'):
+            simu = run_simulation(1, render_workers=2, render_queue_size=1,
+                                  render_backend=backend,
+                                  time_visualize=(0, 1, 2, 3))
+            for t in range(4):
+                self.assertTrue(os.path.exists(os.path.join(
+                    simu.results_dir(), 't%d.png' % t)))
+
+    def test_unknown_backend(self):
+        self.assertRaises(SimulationException, SnapshotRenderer,
+                          make_config(render_backend='svg'))
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def test_recorder_reader(self):
+        for compress in (False, True):
+            directory = temporary_dir()
+            frames = np.arange(7 * 6).reshape(7, 2, 3).astype(np.float32)
+            recorder = TrajectoryRecorder(directory, {'m': np.float32},
+                                          (2, 3), 10, chunk_rounds=3,
+                                          compress=compress)
+            for frame in frames:
+                recorder.record({'m': frame})
+            recorder.close()
+            reader = TrajectoryReader(directory)
+            self.assertEqual(len(reader), 7)
+            self.assertTrue(np.array_equal(reader.rounds('m'), frames))
+            self.assertTrue(np.array_equal(reader.rounds('m', 2, 5),
+                                           frames[2:5]))
+            self.assertTrue(np.array_equal(reader.round('m', 6), frames[6]))
+            self.assertTrue(np.array_equal(reader.cell('m', (1, 2), 1),
+                                           frames[1:, 1, 2]))
+
+    def test_simulation_record(self):
+        simu = run_simulation(1, simulation_type='gamma', record=True,
+                              record_chunk_rounds=4, record_compress=True)
+        reader = TrajectoryReader(simu.results_trajectory_dir())
+        self.assertEqual(sorted(reader.names()),
+                         ['intuitive_actions', 'rounds', 'thresholds'])
+        self.assertEqual(len(reader), simu.nround())
+        self.assertTrue(np.array_equal(reader.round('rounds', -1),
+                                       simu.rounds.current()))
+        last = reader.rounds('thresholds', simu.nround() - 1)[0]
+        self.assertAlmostEqual(last.mean(), simu.data('threshold')[-1])
+
+
+class TestGifExport(unittest.TestCase):
+
+    def read_gif(self, path):
+        from PIL import Image
+        palette = np.array(EvoDynUtils.actions_palette())
+        frames = []
+        with Image.open(path) as image:
+            for k in range(image.n_frames):
+                image.seek(k)
+                rgb = np.array(image.convert('RGB'))
+                # Back to palette indexes
+                frames.append(np.argmax(
+                    (rgb[:, :, np.newaxis] == palette).all(axis=3), axis=2))
+        return frames
+
+    def test_gif_writer(self):
+        path = os.path.join(temporary_dir(), 'm.gif')
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 2, (90, 120)) for _ in range(3)]
+        writer = GifWriter(path, EvoDynUtils.actions_palette(), downscale=2)
+        for frame in frames:
+            writer.add_frame(frame)
+        writer.close()
+        read = self.read_gif(path)
+        self.assertEqual(len(read), 3)
+        for frame, read_frame in zip(frames, read):
+            self.assertTrue(np.array_equal(frame[::2, ::2], read_frame))
+
+    def test_simulation_gif(self):
+        simu = run_simulation(1, gif=True, gif_stride=3, record=True,
+                              record_chunk_rounds=4)
+        frames = self.read_gif(simu.results_gif())
+        self.assertEqual(len(frames), 4)
+        self.assertTrue(np.array_equal(frames[-1], simu.rounds.current()))
+        path = os.path.join(simu.results_dir(), 'exported.gif')
+        reader = TrajectoryReader(simu.results_trajectory_dir())
+        self.assertEqual(export_gif(reader, path, stride=3), 4)
+        for live, exported in zip(frames, self.read_gif(path)):
+            self.assertTrue(np.array_equal(live, exported))
+
+
+class TestMultipleSimulation(unittest.TestCase):
+
+    def test_results_do_not_depend_on_workers(self):
+        sequential = run_multiple(workers=1)
+        parallel = run_multiple(workers=3)
+        for key, stats in sequential.stats.items():
+            self.assertEqual(stats.summary(), parallel.stats[key].summary())
+
+    def test_average_plots(self):
+        multiple = run_multiple(quantile_bins=20)
+        self.assertEqual(multiple.nsucceeded, 4)
+        for fig in (multiple.results_coop_fig(),
+                    multiple.results_int_coop_fig(),
+                    multiple.results_threshold_fig()):
+            self.assertTrue(os.path.exists(fig + '.png'))
+
+    def test_average_stopped_simulations(self):
+        multiple = run_multiple(simulation_type='assign2',
+                                     cycle_detection='stop')
+        self.assertTrue(os.path.exists(multiple.results_coop_fig() + '.png'))
+
+    def test_number_of_round_from_seed(self):
+        config = make_config(last_round=(10, 1000), seed=3)
+        first = MultipleSimulation(dict(config)).config['number_of_round']
+        second = MultipleSimulation(dict(config)).config['number_of_round']
+        self.assertEqual(first, second)
+
+    def test_simulation_seeds(self):
+        self.assertEqual(EvoDynUtils.simulation_seed(42, 1),
+                         EvoDynUtils.simulation_seed(42, 1))
+        self.assertNotEqual(EvoDynUtils.simulation_seed(42, 1),
+                            EvoDynUtils.simulation_seed(42, 2))
+
+    def test_failed_simulations_are_reported(self):
+        multiple = MultipleSimulation(make_config(number_of_simulations=2,
+                                                  engine='unknown', workers=2))
+        self.assertRaises(SimulationException, multiple.run)
+        self.assertEqual(sorted(multiple.failed), [0, 1])
+
+    def test_crashed_worker_is_reported(self):
+        multiple = MultipleSimulation(make_config(number_of_simulations=6,
+                                                  last_round=(4, 4),
+                                                  workers=2))
+        with unittest.mock.patch.object(evodyn, 'run_simulation',
+                                        run_simulation_or_crash):
+            multiple.run()
+        self.assertEqual(sorted(multiple.failed), [1])
+        self.assertEqual(multiple.nsucceeded, 5)
+
+
+class TestSweep(unittest.TestCase):
+
+    def spec(self, cache_dir, **spec):
+        spec.update({'cache_dir': cache_dir,
+                     'points': [{'size': 6, 'last_round': (3, 3),
+                                 'time_visualize': ()}]})
+        return spec
+
+    def test_expand(self):
+        overrides = sweep.expand({'b': [1, 2], 'c': [0, 1]},
+                                 [{'size': 5}, {'size': 6}])
+        self.assertEqual(len(overrides), 8)
+        self.assertIn({'size': 6, 'b': 2, 'c': 0}, overrides)
+        self.assertEqual(sweep.expand(), [{}])
+
+    def test_overrides_are_resolved(self):
+        config = EvoDynUtils.get_config(overrides={'b': 5, 'c': 2})
+        self.assertEqual(config['gamma'][0]['payoff'], (5, 3, 0, -2))
+
+    def test_hash_ignores_outputs(self):
+        config = make_config()
+        self.assertEqual(sweep.config_hash(config), sweep.config_hash(
+            dict(config, results_dir='elsewhere', time_visualize=(1,))))
+        for key, value in (('checkpoint_rounds', 5), ('checkpoint_seconds', 60),
+                           ('resume', True), ('instrument', True),
+                           ('threads', 4), ('tile_size', 64)):
+            self.assertEqual(sweep.config_hash(config),
+                             sweep.config_hash(dict(config, **{key: value})))
+        self.assertNotEqual(sweep.config_hash(config),
+                            sweep.config_hash(dict(config, size=13)))
+
+    def test_resume_from_cache(self):
+        cache_dir = temporary_dir()
+        spec = self.spec(cache_dir, grid={'gamma_p': [0.2, 0.8]}, workers=2)
+        results = sweep.Sweep(spec).run()
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(summary is not None for _, _, summary in results))
+        # Simulate an interrupted point
+        os.remove(os.path.join(cache_dir, results[0][1], sweep.Sweep.RESULT))
+        mtime = os.path.getmtime(os.path.join(cache_dir, results[1][1],
+                                              sweep.Sweep.RESULT))
+        resumed = sweep.Sweep(spec).run()
+        self.assertEqual(results, resumed)
+        self.assertEqual(mtime, os.path.getmtime(os.path.join(
+            cache_dir, results[1][1], sweep.Sweep.RESULT)))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def assertSameResumedRun(self, crash_round=7, **overrides):
+        config = make_config(seed=4, checkpoint_rounds=3, **overrides)
+        expected = Simulation(dict(config, results_dir=temporary_dir()), 0)
+        expected.run()
+
+        def crash(simu):
+            if simu.t == crash_round:
+                raise RuntimeError("crash")
+        crashed = Simulation(config, 0)
+        crashed.add_hook('on_round_end', crash)
+        self.assertRaises(RuntimeError, crashed.run)
+        resumed = Simulation(dict(config, resume=True), 0)
+        self.assertEqual(resumed.results_dir(), crashed.results_dir())
+        resumed.run()
+        self.assertEqual(resumed.data(), expected.data())
+        for name in ('rounds', 'scores', 'thresholds', 'intuitive_actions'):
+            self.assertTrue(np.array_equal(
+                getattr(resumed, name).current(),
+                getattr(expected, name).current()))
+        return expected, resumed
+
+    def test_gamma(self):
+        self.assertSameResumedRun(simulation_type='gamma')
+
+    def test_assign2(self):
+        self.assertSameResumedRun(simulation_type='assign2',
+                                  update_mechanism='replicator_rule')
+        self.assertSameResumedRun(simulation_type='assign2',
+                                  engine='vectorized', incremental=True,
+                                  incremental_check=True, size=30)
+        expected, _ = self.assertSameResumedRun(
+            4, simulation_type='assign2', cycle_detection='fast_forward',
+            size=30)
+        self.assertEqual(expected.data('cycle_period'), 4)
+
+    def test_recording(self):
+        for compress in (False, True):
+            expected, resumed = self.assertSameResumedRun(
+                simulation_type='gamma', record=True, record_chunk_rounds=4,
+                record_compress=compress)
+            expected_reader = TrajectoryReader(
+                expected.results_trajectory_dir())
+            resumed_reader = TrajectoryReader(resumed.results_trajectory_dir())
+            self.assertEqual(len(resumed_reader), 10)
+            self.assertTrue(np.array_equal(
+                resumed_reader.rounds('thresholds'),
+                expected_reader.rounds('thresholds')))
+
+    def test_interrupt(self):
+        config = make_config(seed=4, simulation_type='gamma',
+                             checkpoint_seconds=3600)
+        expected = Simulation(dict(config, results_dir=temporary_dir()), 0)
+        expected.run()
+
+        def interrupt(simu):
+            if simu.t == 4:
+                simu.interrupt(signal.SIGINT, None)
+        interrupted = Simulation(config, 0)
+        interrupted.add_hook('on_round_end', interrupt)
+        try:
+            with self.assertRaises(SystemExit):
+                interrupted.run()
+        finally:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.assertEqual(len(interrupted.data('coop_levels')), 5)
+        resumed = Simulation(dict(config, resume=True), 0)
+        resumed.run()
+        self.assertEqual(resumed.data(), expected.data())
+
+    def test_multiple_simulation(self):
+        config = make_config(number_of_simulations=3, last_round=(5, 50),
+                             checkpoint_rounds=2)
+        first = MultipleSimulation(dict(config))
+        first.run()
+        resumed = MultipleSimulation(dict(config, resume=True))
+        self.assertEqual(resumed.master_seed, first.master_seed)
+        resumed.run()
+        self.assertTrue(os.path.exists(os.path.join(
+            resumed.results_dir(), 'simu_0', 'checkpoint.npz')))
+        for key, stats in first.stats.items():
+            self.assertEqual(stats.summary(), resumed.stats[key].summary())
+
+
+class TestBatchSimulation(unittest.TestCase):
+
+    def test_same_data_as_single_simulations(self):
+        for start_method in ('probability', 'middle_cluster'):
+            config = make_config(simulation_type='assign2', periodic=False,
+                                 start_method=start_method)
+            seeds = [EvoDynUtils.simulation_seed(5, simuid)
+                     for simuid in range(3)]
+            batch = BatchSimulation(config, seeds)
+            batch.run()
+            self.assertEqual(batch.data('coop_levels').shape, (3, 10))
+            for replicate, seed in enumerate(seeds):
+                simu = Simulation(config, replicate, seed)
+                simu.run()
+                self.assertEqual(batch.replicate_data(replicate),
+                                 simu.data())
+
+    def test_stochastic_mechanisms(self):
+        for mechanism in ('replicator_rule', 'fermi_rule'):
+            config = make_config(simulation_type='assign2',
+                                 update_mechanism=mechanism)
+            seeds = [EvoDynUtils.simulation_seed(5, simuid)
+                     for simuid in range(2)]
+            batch = BatchSimulation(config, seeds)
+            batch.run()
+            for replicate, seed in enumerate(seeds):
+                simu = Simulation(config, replicate, seed)
+                simu.run()
+                self.assertEqual(batch.replicate_data(replicate),
+                                 simu.data())
+
+    def test_multiple_simulation(self):
+        single = run_multiple(simulation_type='assign2')
+        for workers in (1, 2):
+            batched = run_multiple(simulation_type='assign2', batch_size=3,
+                                   workers=workers)
+            self.assertEqual(batched.nsucceeded, 4)
+            for key, stats in single.stats.items():
+                self.assertEqual(stats.summary(),
+                                 batched.stats[key].summary())
+
+    def test_unsupported(self):
+        for overrides in ({'simulation_type': 'gamma'},
+                          {'simulation_type': 'assign2',
+                           'cycle_detection': 'stop'}):
+            batch = BatchSimulation(make_config(**overrides), [1, 2])
+            self.assertRaises(SimulationException, batch.run)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_summary(self):
+        simu = run_simulation(3, simulation_type='assign2', instrument=True)
+        with open(simu.results_instrumentation()) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['rounds'], 10)
+        self.assertEqual(len(summary['round_seconds']['all']), 10)
+        self.assertEqual(summary['phases']['end_round']['calls'], 10)
+        self.assertNotIn('play_gamma_round', summary['phases'])
+        self.assertEqual(summary['calls_per_cell']['play'], 1)
+        self.assertEqual(summary['calls_per_cell']['calculate_score'], 1)
+        self.assertEqual(summary['peak_lattice_bytes'],
+                         2 * 12 * 12 * (1 + 8 + 8 + 1))
+
+    def test_same_run(self):
+        plain = run_simulation(3, simulation_type='gamma')
+        instrumented = run_simulation(3, simulation_type='gamma',
+                                      instrument=True)
+        self.assertEqual(plain.data(), instrumented.data())
+        self.assertFalse(os.path.exists(plain.results_instrumentation()))
+
+    def test_hooks(self):
+        simu = Simulation(make_config(simulation_type='assign2', seed=3))
+        events = []
+        simu.add_hook('on_round_start', lambda s: events.append(('start', s.t)))
+        simu.add_hook('on_round_end', lambda s: events.append(('end', s.t)))
+        simu.run()
+        self.assertEqual(events[:3], [('start', 0), ('end', 0), ('start', 1)])
+        self.assertEqual(events[-1], ('end', 9))
+        self.assertRaises(SimulationException, simu.add_hook, 'on_run', print)
+
+
+class TestConfig(unittest.TestCase):
+
+    def write_config(self, source):
+        path = os.path.join(temporary_dir(), 'config.py')
+        with open(path, 'w') as f:
+            f.write(source)
+        return path
+
+    def test_sample_as_exec(self):
+        expected = {}
+        with open('sample.py') as f:
+            exec(f.read(), expected)
+        del expected['__builtins__']
+        self.assertEqual(Config.load(), expected)
+
+    def test_expressions(self):
+        path = self.write_config('"""Doc"""\nb = 2\nc = -1\n'
+                                 'game = {"payoff": (b, b - c, b * c ** 2)}\n'
+                                 'sizes = [b // 2, not b]\n')
+        config = Config.load(path, {'b': 4})
+        self.assertEqual(config.game, {'payoff': (4, 5, 4)})
+        self.assertEqual(config['sizes'], [2, False])
+        self.assertRaises(AttributeError, getattr, config, 'size')
+
+    def test_no_code_executed(self):
+        for source in ('import os\n', 'size = len("ab")\n',
+                       'size = __import__("os")\n', 'size = unknown\n',
+                       'if True:\n    size = 2\n', 'size = 10 / 0\n',
+                       'size = (1, 2) - 3\n', 'size = -"a"\n'):
+            self.assertRaises(SimulationException, Config.load,
+                              self.write_config(source))
+
+    def test_types(self):
+        self.assertRaises(SimulationException, Config.load,
+                          self.write_config('size = "50"\n'))
+        self.assertRaises(SimulationException, Config.load,
+                          self.write_config('size = True\n'))
+        self.assertRaises(SimulationException, Simulation,
+                          make_config(periodic=1))
+        Config(size=np.int64(3), start_coop_probability=1).validate()
+
+    def test_unknown_rules(self):
+        for overrides in ({'simulation_type': 'assign3'},
+                          {'simulation_type': 'assign2',
+                           'start_method': 'everywhere'},
+                          {'simulation_type': 'assign2',
+                           'update_mechanism': 'majority'},
+                          {'simulation_type': 'gamma',
+                           'gamma': [{'name': 'chicken',
+                                      'payoff': (1, 1, 1, 1)}]}):
+            self.assertRaises(SimulationException, Simulation,
+                              make_config(**overrides))
+
+
+class TestHeadless(unittest.TestCase):
+
+    def test_lazy_matplotlib(self):
+        code = "import sys, evodyn; print('matplotlib' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(
+                                             os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_simulation(self):
+        plotted = run_simulation(3, simulation_type='gamma',
+                                 time_visualize=(1, 2))
+        headless = run_simulation(3, simulation_type='gamma',
+                                  time_visualize=(1, 2), plots=False)
+        self.assertEqual(headless.data(), plotted.data())
+        self.assertIn('t1.png', os.listdir(plotted.results_dir()))
+        self.assertEqual(os.listdir(headless.results_dir()), [])
+
+    def test_multiple_simulation(self):
+        plotted = run_multiple()
+        headless = run_multiple(plots=False)
+        self.assertFalse(os.path.exists(plotted.results_summary()))
+        self.assertFalse(os.path.exists(
+            headless.results_coop_fig() + '.png'))
+        with open(headless.results_summary()) as f:
+            self.assertEqual(json.load(f)['stats'],
+                             json.loads(json.dumps(plotted.summary()))['stats'])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_phases(self):
+        for engine in benchmark.ENGINES['assign2']:
+            assign2 = benchmark.benchmark_case(make_config(
+                simulation_type='assign2', engine=engine, tile_size=5,
+                threads=2), 2)
+            self.assertEqual(sorted(assign2), ['gather', 'init', 'play',
+                                               'plot', 'round', 'score'])
+        gamma = benchmark.benchmark_case(make_config(simulation_type='gamma'),
+                                         2)
+        self.assertEqual(sorted(gamma), ['gather', 'init', 'plot', 'round'])
+
+    def test_threaded_pool_shut_down(self):
+        threads = threading.active_count()
+        benchmark.benchmark_case(make_config(simulation_type='assign2',
+                                             engine='threaded', threads=3), 2)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(benchmark.case_name('assign2', 'moore', 'threaded',
+                                             100, 4),
+                         'assign2/moore/threaded-4/100')
+
+    def test_import_time(self):
+        times = benchmark.benchmark_import(1)
+        self.assertGreater(times['evodyn'], 0)
+        self.assertEqual(sorted(times), ['evodyn', 'numpy'])
+
+    def test_compare(self):
+        baseline = {'results': {'a': {'play': 1.0, 'score': 1.0},
+                                'b': {'play': 0.0001}}}
+        current = {'results': {'a': {'play': 1.1, 'score': 1.5},
+                               'b': {'play': 0.0005},
+                               'c': {'play': 5.0}}}
+        self.assertEqual(benchmark.compare(baseline, current, 0.2),
+                         [('a', 'score', 1.0, 1.5)])
+
 
 if __name__ == '__main__':
     unittest.main()